@@ -25,19 +25,31 @@
 """ Compression and Archiving
 
 Utility functions for creating archive files (tarballs, zip files, etc)
-and compressing files (gzip, bzip2, lzop, etc)
+and compressing files (gzip, bzip2, lzop, xz, zstd, etc)
 """
 
 import os
+import bz2
+import zlib
 import shutil
+import tarfile
 import tempfile
+import threading
 import subprocess
+import collections
+import multiprocessing
+import multiprocessing.dummy
 from mic import msger
+from mic.utils import Filemap
 
 __all__ = [
             "get_compress_formats",
             "compress",
             "decompress",
+            "open_compressor",
+            "open_decompressor",
+            "set_compress_threads",
+            "read_sparse",
             "get_archive_formats",
             "get_archive_suffixes",
             "make_archive",
@@ -48,6 +60,26 @@ __all__ = [
 
 # TODO: refine Error class for archive/extract
 
+# the number of threads used by the compressors, 0 for one per CPU
+_compress_threads = 0
+
+def set_compress_threads(threads):
+    """ Set the number of threads used for compressing
+
+    @threads: the number of threads, 0 for one thread per CPU
+    """
+    global _compress_threads
+    _compress_threads = threads
+
+def _get_compress_threads():
+    """ Get the number of threads used for compressing """
+    if _compress_threads > 0:
+        return _compress_threads
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
 def which(binary, path=None):
     """ Find 'binary' in the directories listed in 'path'
 
@@ -63,6 +95,55 @@ def which(binary, path=None):
             return fpath
     return None
 
+def _get_data_ranges(fileobj):
+    """ Get the byte ranges of a file which hold data
+
+    @fileobj: the file object of a regular file
+    @retval: a tuple (file size, a list of (start, end) ranges), the rest of
+             the file is holes. The whole file is one range if the holes
+             can't be found.
+    """
+    size = os.fstat(fileobj.fileno()).st_size
+    try:
+        fmap = Filemap.filemap(fileobj)
+    except (Filemap.Error, Filemap.ErrorNotSupp):
+        if size:
+            return (size, [(0, size)])
+        return (size, [])
+
+    ranges = []
+    for first, last in fmap.get_mapped_ranges(0, fmap.blocks_cnt):
+        ranges.append((first * fmap.block_size,
+                       min((last + 1) * fmap.block_size, size)))
+    return (size, ranges)
+
+def read_sparse(fileobj, chunk_size=1024 * 1024):
+    """ Read a file chunk by chunk without reading its holes
+
+    The holes are found with FIEMAP or SEEK_HOLE, they are produced as
+    zeroes without touching the disk.
+
+    @fileobj: the file object of a regular file
+    @chunk_size: the maximum size of the chunks
+    @retval: an iterator of the chunks of the whole file data
+    """
+    zeroes = "\0" * chunk_size
+    size, ranges = _get_data_ranges(fileobj)
+    offset = 0
+    for start, end in ranges + [(size, size)]:
+        while offset < start:
+            length = min(chunk_size, start - offset)
+            yield zeroes[:length]
+            offset += length
+
+        fileobj.seek(start)
+        while offset < end:
+            data = fileobj.read(min(chunk_size, end - offset))
+            if not data:
+                raise IOError, "unexpected end of file '%s'" % fileobj.name
+            yield data
+            offset += len(data)
+
 def _call_external(cmdln_or_args):
     """ Wapper for subprocess calls.
 
@@ -82,105 +163,29 @@ def _call_external(cmdln_or_args):
 
     return (proc.returncode, outdata, errdata)
 
-def _do_gzip(input_name, compression=True):
-    """ Compress/decompress the file with 'gzip' utility.
-
-    @input_name: the file name to compress/decompress
-    @compress: True for compressing, False for decompressing
-    @retval: the path of the compressed/decompressed file
-    """
-    if which("pigz") is not None:
-        compressor = "pigz"
-    else:
-        compressor = "gzip"
-
-    if compression:
-        cmdln = [compressor, "-f", input_name]
-    else:
-        cmdln = [compressor, "-d", "-f", input_name]
-
-    _call_external(cmdln)
-
-    if compression:
-        output_name = input_name + ".gz"
-    else:
-        # suppose that file name is suffixed with ".gz"
-        output_name = os.path.splitext(input_name)[0]
-
-    return output_name
-
-def _do_bzip2(input_name, compression=True):
-    """ Compress/decompress the file with 'bzip2' utility.
-
-    @input_name: the file name to compress/decompress
-    @compress: True for compressing, False for decompressing
-    @retval: the path of the compressed/decompressed file
-    """
-    if which("pbzip2") is not None:
-        compressor = "pbzip2"
-    else:
-        compressor = "bzip2"
-
-    if compression:
-        cmdln = [compressor, "-f", input_name]
-    else:
-        cmdln = [compressor, "-d", "-f", input_name]
-
-    _call_external(cmdln)
-
-    if compression:
-        output_name = input_name + ".bz2"
-    else:
-        # suppose that file name is suffixed with ".bz2"
-        output_name = os.path.splitext(input_name)[0]
-
-    return output_name
-
-def _do_lzop(input_name, compression=True):
-    """ Compress/decompress the file with 'lzop' utility.
-
-    @input_name: the file name to compress/decompress
-    @compress: True for compressing, False for decompressing
-    @retval: the path of the compressed/decompressed file
-    """
-    compressor = "lzop"
-
-    if compression:
-        cmdln = [compressor, "-f", "-U", input_name]
-    else:
-        cmdln = [compressor, "-d", "-f", "-U", input_name]
-
-    _call_external(cmdln)
-
-    if compression:
-        output_name = input_name + ".lzo"
-    else:
-        # suppose that file name is suffixed with ".lzo"
-        output_name = os.path.splitext(input_name)[0]
-
-    return output_name
-
 _COMPRESS_SUFFIXES = {
     ".lzo"     : [".lzo"],
     ".gz"      : [".gz"],
     ".bz2"     : [".bz2", ".bz"],
+    ".xz"      : [".xz"],
+    ".zst"     : [".zst"],
     ".tar.lzo" : [".tar.lzo", ".tzo"],
     ".tar.gz"  : [".tar.gz", ".tgz", ".taz"],
     ".tar.bz2" : [".tar.bz2", ".tbz", ".tbz2", ".tar.bz"],
+    ".tar.xz"  : [".tar.xz", ".txz"],
+    ".tar.zst" : [".tar.zst", ".tzst"],
 }
 
-_COMPRESS_FORMATS = {
-    "gz" :  _do_gzip,
-    "bz2":  _do_bzip2,
-    "lzo":  _do_lzop,
-}
+# gz and bz2 are handled in process, the others by the external tools, see
+# open_compressor() and open_decompressor()
+_COMPRESS_FORMATS = ("gz", "bz2", "lzo", "xz", "zst")
 
 def get_compress_formats():
     """ Get the list of the supported compression formats
 
     @retval: a list contained supported compress formats
     """
-    return _COMPRESS_FORMATS.keys()
+    return list(_COMPRESS_FORMATS)
 
 def get_compress_suffixes():
     """ Get the list of the support suffixes
@@ -205,11 +210,310 @@ def compress(file_path, compress_format):
     if not os.path.isfile(file_path):
         raise OSError, "can't compress a file not existed: '%s'" % file_path
 
-    try:
-        func = _COMPRESS_FORMATS[compress_format]
-    except KeyError:
+    if compress_format not in _COMPRESS_FORMATS:
         raise ValueError, "unknown compress format '%s'" % compress_format
-    return func(file_path, True)
+
+    output_name = "%s.%s" % (file_path, compress_format)
+    msger.info("Compressing %s to %s" % (file_path, output_name))
+    tmp_name = output_name + ".part"
+    try:
+        with open(file_path, "rb") as fsrc:
+            with open(tmp_name, "wb") as fdst:
+                compressor = open_compressor(fdst, compress_format)
+                for chunk in read_sparse(fsrc):
+                    compressor.write(chunk)
+                compressor.close()
+    except:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+    shutil.copystat(file_path, tmp_name)
+    os.rename(tmp_name, output_name)
+    os.unlink(file_path)
+    return output_name
+
+def _gzip_block(data):
+    """ Compress 'data' to a gzip member """
+    compressobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressobj.compress(data) + compressobj.flush()
+
+def _bzip2_block(data):
+    """ Compress 'data' to a bzip2 stream """
+    return bz2.compress(data, 9)
+
+class _Compressed(object):
+    """ An already compressed block, in place of a pending pool result """
+    def __init__(self, data):
+        self._data = data
+
+    def get(self):
+        return self._data
+
+class _BlockCompressor(object):
+    """ File-like object compressing the data block by block
+
+    Every block is compressed independently by 'compress_block' in a pool of
+    'threads' threads, and the results are written to 'fileobj' in order.
+    zlib and bz2 release the GIL while compressing, so the blocks are really
+    compressed at the same time. The concatenated gzip members or bzip2
+    streams form a valid gzip or bzip2 file.
+
+    Blocks of zeroes, which make most of a sparse image, are compressed only
+    once.
+    """
+    block_size = 4 * 1024 * 1024
+    _zero_block = "\0" * block_size
+
+    def __init__(self, compress_block, fileobj, threads):
+        self._compress_block = compress_block
+        self._fileobj = fileobj
+        self._threads = threads
+        self._buf = []
+        self._buflen = 0
+        self._blocks = 0
+        self._compressed_zero_block = None
+        self._pending = collections.deque()
+        if threads > 1:
+            self._pool = multiprocessing.dummy.Pool(threads)
+        else:
+            self._pool = None
+
+    def _submit(self, block):
+        self._blocks += 1
+        if block == self._zero_block:
+            if self._compressed_zero_block is None:
+                self._compressed_zero_block = self._compress_block(block)
+            result = _Compressed(self._compressed_zero_block)
+        elif self._pool is None:
+            result = _Compressed(self._compress_block(block))
+        else:
+            result = self._pool.apply_async(self._compress_block, (block,))
+
+        if self._pool is None:
+            self._fileobj.write(result.get())
+            return
+
+        self._pending.append(result)
+        # bound the memory taken by the blocks in flight
+        while len(self._pending) > 2 * self._threads:
+            self._fileobj.write(self._pending.popleft().get())
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen < self.block_size:
+            return
+
+        data = "".join(self._buf)
+        offset = 0
+        while len(data) - offset >= self.block_size:
+            self._submit(data[offset:offset + self.block_size])
+            offset += self.block_size
+        self._buf = [data[offset:]]
+        self._buflen = len(data) - offset
+
+    def close(self):
+        try:
+            # an empty input still gets an empty gzip member or bzip2 stream
+            if self._buflen or not self._blocks:
+                self._submit("".join(self._buf))
+            self._buf = []
+            self._buflen = 0
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().get())
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def abort(self):
+        """ Stop compressing, the blocks not written yet are dropped """
+        self._buf = []
+        self._buflen = 0
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+class _PipeCompressor(object):
+    """ File-like object feeding an external compressor or decompressor
+
+    The output is read back from the tool by a helper thread
+    and written to 'fileobj', so the caller sees the compressor output
+    without any temporary file.
+    """
+    def __init__(self, cmdln, fileobj):
+        self._cmdln = cmdln
+        self._fileobj = fileobj
+        self._error = None
+        self._proc = subprocess.Popen(cmdln, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      close_fds=True)
+        self._thread = threading.Thread(target=self._pump)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _pump(self):
+        chunk_size = 1024 * 1024
+        while True:
+            chunk = self._proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            if self._error:
+                # keep draining, the compressor would block otherwise
+                continue
+            try:
+                self._fileobj.write(chunk)
+            except (IOError, OSError), err:
+                self._error = err
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def close(self):
+        self._proc.stdin.close()
+        self._thread.join()
+        returncode = self._proc.wait()
+        if self._error:
+            raise self._error
+        if returncode != 0:
+            raise OSError, "%s failed with exit code %d" \
+                           % (self._cmdln[0], returncode)
+
+    def abort(self):
+        """ Kill the tool, the data not written yet is dropped """
+        try:
+            self._proc.kill()
+        except OSError:
+            # it has exited already
+            pass
+        try:
+            self._proc.stdin.close()
+        except IOError:
+            pass
+        self._thread.join()
+        self._proc.wait()
+
+def _compressor_cmdln(compress_format, threads):
+    """ Get the command line compressing stdin to stdout """
+    if compress_format == "lzo":
+        return ["lzop", "-c"]
+    elif compress_format == "xz":
+        return ["xz", "-T%d" % threads, "-c"]
+    elif compress_format == "zst":
+        return ["zstd", "-q", "-T%d" % threads, "-c"]
+
+    raise ValueError, "unknown compress format '%s'" % compress_format
+
+def open_compressor(fileobj, compress_format, threads=None):
+    """ Open a stream compressor
+
+    gzip and bzip2 are compressed in process, with the input split into
+    blocks compressed in parallel; the other formats are compressed by the
+    external tools, using their own threads where they have them.
+
+    @fileobj: the file object to write the compressed data to
+    @compress_format: the compression format
+    @threads: the number of threads, None for set_compress_threads() value
+    @retval: a file-like object, the data written to it is compressed
+             into 'fileobj', close() it to flush all the data, or abort()
+             it to give up
+    """
+    if threads is None:
+        threads = _get_compress_threads()
+
+    if compress_format == "gz":
+        return _BlockCompressor(_gzip_block, fileobj, threads)
+    elif compress_format == "bz2":
+        return _BlockCompressor(_bzip2_block, fileobj, threads)
+
+    return _PipeCompressor(_compressor_cmdln(compress_format, threads),
+                           fileobj)
+
+class _StreamDecompressor(object):
+    """ File-like object decompressing the data in process
+
+    'new_decompressor' returns a zlib or bz2 decompressor object, a new one
+    is started for every member of a multi-member stream.
+    """
+    def __init__(self, new_decompressor, fileobj):
+        self._new_decompressor = new_decompressor
+        self._fileobj = fileobj
+        self._decompressor = new_decompressor()
+
+    def write(self, data):
+        while data:
+            try:
+                self._fileobj.write(self._decompressor.decompress(data))
+            except EOFError:
+                # bz2 raises it for the data after the end of the stream
+                self._decompressor = self._new_decompressor()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._new_decompressor()
+
+    def _finished(self):
+        """ Whether the current gzip member or bzip2 stream is complete,
+        with its trailer """
+        if hasattr(self._decompressor, "copy"):
+            # a complete zlib stream leaves any more data unused
+            probe = self._decompressor.copy()
+            try:
+                probe.decompress("\0")
+            except zlib.error:
+                return False
+            return probe.unused_data == "\0"
+
+        try:
+            self._decompressor.decompress("")
+        except EOFError:
+            return True
+        return False
+
+    def close(self):
+        finished = self._finished()
+        if hasattr(self._decompressor, "flush"):
+            self._fileobj.write(self._decompressor.flush())
+        if not finished:
+            raise IOError, "unexpected end of the compressed data"
+
+    def abort(self):
+        self._decompressor = self._new_decompressor()
+
+def _decompressor_cmdln(compress_format):
+    """ Get the command line decompressing stdin to stdout """
+    if compress_format == "lzo":
+        return ["lzop", "-dc"]
+    elif compress_format == "xz":
+        return ["xz", "-dc"]
+    elif compress_format == "zst":
+        return ["zstd", "-q", "-dc"]
+
+    raise ValueError, "unknown compress format '%s'" % compress_format
+
+def open_decompressor(fileobj, compress_format):
+    """ Open a stream decompressor
+
+    gzip and bzip2 are decompressed in process, the other formats by the
+    external tools.
+
+    @fileobj: the file object to write the decompressed data to
+    @compress_format: the compression format
+    @retval: a file-like object, the data written to it is decompressed
+             into 'fileobj', close() it to flush all the data, or abort()
+             it to give up
+    """
+    if compress_format == "gz":
+        return _StreamDecompressor(
+                    lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), fileobj)
+    elif compress_format == "bz2":
+        return _StreamDecompressor(bz2.BZ2Decompressor, fileobj)
+
+    return _PipeCompressor(_decompressor_cmdln(compress_format), fileobj)
 
 def decompress(file_path, decompress_format=None):
     """ Decompess a give file
@@ -234,33 +538,33 @@ def decompress(file_path, decompress_format=None):
     if not decompress_format:
         decompress_format = os.path.splitext(file_path)[1].lstrip(".")
 
-    try:
-        func = _COMPRESS_FORMATS[decompress_format]
-    except KeyError:
+    if decompress_format not in _COMPRESS_FORMATS:
         raise ValueError, "unknown decompress format '%s'" % decompress_format
-    return func(file_path, False)
-
 
-def _do_tar(archive_name, target_name):
-    """ Archive the directory or the file with 'tar' utility
-
-    @archive_name: the name of the tarball file
-    @target_name: the name of the target to tar
-    @retval: the path of the archived file
-    """
-    if os.path.isdir(target_name):
-        target_dir = target_name
-        target_name = "."
-    else:
-        target_dir = os.path.dirname(target_name)
-        target_name = os.path.basename(target_name)
-
-    cmdln = ["tar", "-S", "-C", target_dir, "-cf", archive_name, target_name]
-
-
-    _call_external(cmdln)
+    # suppose that file name is suffixed with the format
+    output_name = os.path.splitext(file_path)[0]
+    msger.info("Decompressing %s to %s" % (file_path, output_name))
+    tmp_name = output_name + ".part"
+    try:
+        with open(file_path, "rb") as fsrc:
+            with open(tmp_name, "wb") as fdst:
+                decompressor = open_decompressor(fdst, decompress_format)
+                try:
+                    shutil.copyfileobj(fsrc, decompressor, 1024 * 1024)
+                except:
+                    decompressor.abort()
+                    raise
+                decompressor.close()
+    except:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+    shutil.copystat(file_path, tmp_name)
+    os.rename(tmp_name, output_name)
+    os.unlink(file_path)
+    return output_name
 
-    return archive_name
 
 def _do_untar(archive_name, target_dir=None):
     """ Unarchive the archived file with 'tar' utility
@@ -278,17 +582,61 @@ def _do_untar(archive_name, target_dir=None):
     if returncode != 0:
         raise OSError, os.linesep.join([stdout, stderr])
 
-def _imp_tarfile(archive_name, target_name):
-    """ Archive the directory or the file with tarfile module
+def _do_tar(fileobj, target_name):
+    """ Archive the directory or the file with 'tar' utility
+
+    GNU tar writes the tarball to its stdout, which is copied to 'fileobj',
+    the holes of the sparse files are detected by tar itself (-S).
 
-    @archive_name: the name of the tarball file
+    @fileobj: the file object to write the tarball to
     @target_name: the name of the target to tar
-    @retval: the path of the archived file
+    raise exception if fail to archive
     """
-    import tarfile
+    if os.path.isdir(target_name):
+        target_dir = target_name
+        target_name = "."
+    else:
+        target_dir = os.path.dirname(target_name)
+        target_name = os.path.basename(target_name)
+
+    cmdln = ["tar", "-S", "-C", target_dir, "-cf", "-", target_name]
+    msger.info("Running command: " + " ".join(cmdln))
+
+    proc = subprocess.Popen(cmdln, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, close_fds=True)
+    stderr = []
+    pump = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+    pump.daemon = True
+    pump.start()
+    try:
+        while True:
+            chunk = proc.stdout.read(1024 * 1024)
+            if not chunk:
+                break
+            fileobj.write(chunk)
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+        pump.join()
+
+    if proc.wait() != 0:
+        raise OSError, "".join(stderr)
+
+def _imp_tarfile(fileobj, target_name):
+    """ Archive the directory or the file with tarfile module
+
+    Used when there is no 'tar' utility, the sparse files are stored
+    with their holes.
 
-    msger.info("Taring files to %s using tarfile module" % archive_name)
-    tar = tarfile.open(archive_name, 'w')
+    @fileobj: the file object to write the tarball to
+    @target_name: the name of the target to tar
+    """
+    msger.info("Taring files of %s" % target_name)
+    tar = tarfile.open(fileobj=fileobj, mode='w|',
+                       format=tarfile.GNU_FORMAT)
     if os.path.isdir(target_name):
         for child in os.listdir(target_name):
             tar.add(os.path.join(target_name, child), child)
@@ -296,26 +644,49 @@ def _imp_tarfile(archive_name, target_name):
         tar.add(target_name, os.path.basename(target_name))
 
     tar.close()
-    return archive_name
 
 def _make_tarball(archive_name, target_name, compressor=None):
     """ Create a tarball from all the files under 'target_name' or itself.
 
+    The tar stream is compressed on the fly, no uncompressed tarball is
+    written to the disk.
+
     @archive_name: the name of the archived file to create
     @target_name: the directory or the file name to archive
-    @compressor: callback function to compress the tarball
+    @compressor: the compression format of the tarball, None for a plain one
     @retval: indicate the compressing result
     """
-    archive_dir = os.path.dirname(archive_name)
-    tarball_name = tempfile.mktemp(suffix=".tar", dir=archive_dir)
+    archive_dir = os.path.dirname(archive_name) or os.curdir
+    (fd, tarball_name) = tempfile.mkstemp(suffix=".part", dir=archive_dir)
 
-    if which("tar") is not None:
-        _do_tar(tarball_name, target_name)
-    else:
-        _imp_tarfile(tarball_name, target_name)
+    # mkstemp creates the file with 0600, give it the usual mode
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(fd, 0666 & ~umask)
 
-    if compressor:
-        tarball_name = compressor(tarball_name, True)
+    try:
+        with os.fdopen(fd, "wb") as fdst:
+            if compressor:
+                sink = open_compressor(fdst, compressor)
+            else:
+                sink = fdst
+
+            try:
+                if which("tar") is not None:
+                    _do_tar(sink, target_name)
+                else:
+                    _imp_tarfile(sink, target_name)
+            except:
+                if compressor:
+                    sink.abort()
+                raise
+
+            if compressor:
+                sink.close()
+    except:
+        if os.path.exists(tarball_name):
+            os.unlink(tarball_name)
+        raise
 
     shutil.move(tarball_name, archive_name)
 
@@ -362,14 +733,18 @@ _ARCHIVE_SUFFIXES = {
     "lzotar": [".tzo", ".tar.lzo"],
     "gztar" : [".tgz", ".taz", ".tar.gz"],
     "bztar" : [".tbz", ".tbz2", ".tar.bz", ".tar.bz2"],
+    "xztar" : [".txz", ".tar.xz"],
+    "zsttar": [".tzst", ".tar.zst"],
 }
 
 _ARCHIVE_FORMATS = {
     "zip"   : ( _make_zipfile, {} ),
     "tar"   : ( _make_tarball, {"compressor" : None} ),
-    "lzotar": ( _make_tarball, {"compressor" : _do_lzop} ),
-    "gztar" : ( _make_tarball, {"compressor" : _do_gzip} ),
-    "bztar" : ( _make_tarball, {"compressor" : _do_bzip2} ),
+    "lzotar": ( _make_tarball, {"compressor" : "lzo"} ),
+    "gztar" : ( _make_tarball, {"compressor" : "gz"} ),
+    "bztar" : ( _make_tarball, {"compressor" : "bz2"} ),
+    "xztar" : ( _make_tarball, {"compressor" : "xz"} ),
+    "zsttar": ( _make_tarball, {"compressor" : "zst"} ),
 }
 
 def get_archive_formats():
@@ -24,7 +24,8 @@ import subprocess
 import rpm
 from mic import msger
 from mic.utils import errors, proxy, misc
-from mic.utils.rpmmisc import readRpmHeader, RPMInstallCallback
+from mic.utils.rpmmisc import readRpmHeader, RPMInstallCallback, \
+                              warnUnresolvedDeps
 from mic.chroot import cleanup_mounts, setup_chrootenv, cleanup_chrootenv
 
 PATH_BOOTSTRAP = "/usr/sbin:/usr/bin:/sbin:/bin"
@@ -103,6 +104,13 @@ class MiniBackend(object):
             self.run_pkg_script(pkg, prog, script, '1')
 
     def downloadPkgs(self):
+        # the bootstrap has always been installed without the rpm dependency
+        # check, so the problems the metadata show are only reported
+        unresolved = misc.check_package_deps(self.dlpkgs, self.repomd,
+                                             self.arch)
+        if unresolved:
+            warnUnresolvedDeps(unresolved)
+
         nonexist = []
         for pkg in self.dlpkgs:
             localpth = misc.get_package(pkg, self.repomd, self.arch)
@@ -75,6 +75,11 @@ class ConfigMgr(object):
                     "extrarepos": {},
                     "ignore_ksrepo": False,
                     "strict_mode": False,
+                    "download_jobs": 1,
+                    "compress_threads": 0,
+                    "package_store": None,
+                    "cache_size": 0,
+                    "plan": False,
                 },
                 'chroot': {
                     "saveto": None,
@@ -182,6 +187,23 @@ class ConfigMgr(object):
 
         proxy.set_proxies(self.create['proxy'], self.create['no_proxy'])
 
+        try:
+            self.create['download_jobs'] = int(self.create['download_jobs'])
+        except ValueError:
+            raise errors.ConfigError("%s: download_jobs should be a number"
+                                     % siteconf)
+        try:
+            self.create['compress_threads'] = \
+                    int(self.create['compress_threads'])
+        except ValueError:
+            raise errors.ConfigError("%s: compress_threads should be a number"
+                                     % siteconf)
+        try:
+            self.create['cache_size'] = int(self.create['cache_size'])
+        except ValueError:
+            raise errors.ConfigError("%s: cache_size should be a number"
+                                     % siteconf)
+
         # bootstrap option handling
         self.set_runtime(self.create['runtime'])
         if isinstance(self.bootstrap['packages'], basestring):
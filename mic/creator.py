@@ -133,6 +133,26 @@ class Creator(cmdln.Cmdln):
                              dest='strict_mode', default=False,
                              help='Abort creation of image, if there are some errors'
                                   ' during rpm installation. ')
+        optparser.add_option('', '--download-jobs', type='int',
+                             dest='download_jobs', default=None,
+                             help='Number of packages to download in parallel,'
+                                  ' default is 1')
+        optparser.add_option('', '--compress-threads', type='int',
+                             dest='compress_threads', default=None,
+                             help='Number of threads used to compress images,'
+                                  ' default is 0, one thread per CPU')
+        optparser.add_option('', '--package-store', type='string',
+                             dest='package_store', default=None,
+                             help='Directory of a package store shared by all'
+                                  ' cache directories')
+        optparser.add_option('', '--cache-size', type='int',
+                             dest='cache_size', default=None,
+                             help='Size limit of the cache directory in MB,'
+                                  ' default is 0, no limit')
+        optparser.add_option('', '--plan', action='store_true',
+                             dest='plan', default=False,
+                             help='Resolve the packages to install and print'
+                                  ' the plan in JSON, without creating image')
         return optparser
 
     def preoptparse(self, argv):
@@ -232,6 +252,28 @@ class Creator(cmdln.Cmdln):
 
         if self.options.strict_mode:
           configmgr.create['strict_mode'] = self.options.strict_mode
+        if self.options.download_jobs is not None:
+            if self.options.download_jobs < 1:
+                raise errors.Usage('Invalid download jobs: %d, it should be'
+                                   ' a positive number'
+                                   % self.options.download_jobs)
+            configmgr.create['download_jobs'] = self.options.download_jobs
+        if self.options.compress_threads is not None:
+            if self.options.compress_threads < 0:
+                raise errors.Usage('Invalid compress threads: %d, it should be'
+                                   ' 0 or a positive number'
+                                   % self.options.compress_threads)
+            configmgr.create['compress_threads'] = \
+                    self.options.compress_threads
+        if self.options.cache_size is not None:
+            if self.options.cache_size < 0:
+                raise errors.Usage('Invalid cache size: %d, it should be'
+                                   ' 0 or a positive number'
+                                   % self.options.cache_size)
+            configmgr.create['cache_size'] = self.options.cache_size
+        if self.options.package_store is not None:
+            configmgr.create['package_store'] = \
+                    abspath(self.options.package_store)
         if self.options.arch is not None:
             supported_arch = sorted(rpmmisc.archPolicies.keys(), reverse=True)
             if self.options.arch in supported_arch:
@@ -248,6 +290,13 @@ class Creator(cmdln.Cmdln):
         if self.options.runtime:
             configmgr.set_runtime(self.options.runtime)
 
+        if self.options.plan:
+            configmgr.create['plan'] = True
+            # nothing is built, so the bootstrap isn't needed, and stdout is
+            # left to the plan
+            configmgr.create['runtime'] = 'native'
+            msger.log_to_stderr()
+
         if self.options.pack_to is not None:
             configmgr.create['pack_to'] = self.options.pack_to
 
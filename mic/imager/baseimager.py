@@ -34,9 +34,10 @@ import rpm
 from mic import kickstart
 from mic import msger, __version__ as VERSION
 from mic.utils.errors import CreatorError, Abort
-from mic.utils import misc, grabber, runner, fs_related as fs
+from mic.utils import misc, grabber, runner, pkgstore, cachemgr, \
+                      fs_related as fs
 from mic.chroot import kill_proc_inchroot
-from mic.archive import get_archive_suffixes
+from mic.archive import get_archive_suffixes, set_compress_threads
 
 class BaseImageCreator(object):
     """Installs a system to a chroot directory.
@@ -83,6 +84,10 @@ class BaseImageCreator(object):
         self.installerfw_prefix = "INSTALLERFW_"
         self.target_arch = "noarch"
         self.strict_mode = False
+        self.download_jobs = 1
+        self.compress_threads = 0
+        self.package_store = None
+        self.cache_size = 0
         self._local_pkgs_path = None
         self.pack_to = None
         self.repourl = {}
@@ -115,11 +120,16 @@ class BaseImageCreator(object):
                 if '@NAME@' in self.pack_to:
                     self.pack_to = self.pack_to.replace('@NAME@', self.name)
                 (tar, ext) = os.path.splitext(self.pack_to)
-                if ext in (".gz", ".bz2", ".lzo", ".bz") and tar.endswith(".tar"):
+                if ext in (".gz", ".bz2", ".lzo", ".bz", ".xz", ".zst") \
+                   and tar.endswith(".tar"):
                     ext = ".tar" + ext
                 if ext not in get_archive_suffixes():
                     self.pack_to += ".tar"
 
+        set_compress_threads(self.compress_threads)
+        pkgstore.set_package_store(self.package_store)
+        cachemgr.set_cache_size(self.cache_size * 1024 * 1024)
+
         self._dep_checks = ["ls", "bash", "cp", "echo", "modprobe"]
 
         # Output image file names
@@ -998,18 +1008,8 @@ class BaseImageCreator(object):
                     fpath = os.path.join(root, fname)
                     self._attachment.append(fpath)
 
-    def install(self, repo_urls=None):
-        """Install packages into the install root.
-
-        This function installs the packages listed in the supplied kickstart
-        into the install root. By default, the packages are installed from the
-        repository URLs specified in the kickstart.
-
-        repo_urls -- a dict which maps a repository name to a repository;
-                     if supplied, this causes any repository URLs specified in
-                     the kickstart to be overridden.
-
-        """
+    def __setup_pkg_manager(self, repo_urls=None):
+        """Set up the package manager with the repos of the kickstart"""
         def get_ssl_verify(ssl_verify=None):
             if ssl_verify is not None:
                 return not ssl_verify.lower().strip() == 'no'
@@ -1040,6 +1040,9 @@ class BaseImageCreator(object):
             if 'debuginfo' in self.install_pkgs:
                 pkg_manager.install_debuginfo = True
 
+        if hasattr(pkg_manager, 'download_jobs'):
+            pkg_manager.download_jobs = self.download_jobs
+
         for repo in kickstart.get_repos(self.ks, repo_urls, self.ignore_ksrepo):
             (name, baseurl, mirrorlist, inc, exc,
              proxy, proxy_username, proxy_password, debuginfo,
@@ -1058,13 +1061,32 @@ class BaseImageCreator(object):
         if kickstart.inst_langs(self.ks) != None:
             rpm.addMacro("_install_langs", kickstart.inst_langs(self.ks))
 
+        return pkg_manager
+
+    def __mark_packages(self, pkg_manager):
+        self.__preinstall_packages(pkg_manager)
+        self.__select_packages(pkg_manager)
+        self.__select_groups(pkg_manager)
+        self.__deselect_packages(pkg_manager)
+        self.__localinst_packages(pkg_manager)
+        self.__check_packages(pkg_manager)
+
+    def install(self, repo_urls=None):
+        """Install packages into the install root.
+
+        This function installs the packages listed in the supplied kickstart
+        into the install root. By default, the packages are installed from the
+        repository URLs specified in the kickstart.
+
+        repo_urls -- a dict which maps a repository name to a repository;
+                     if supplied, this causes any repository URLs specified in
+                     the kickstart to be overridden.
+
+        """
+        pkg_manager = self.__setup_pkg_manager(repo_urls)
+
         try:
-            self.__preinstall_packages(pkg_manager)
-            self.__select_packages(pkg_manager)
-            self.__select_groups(pkg_manager)
-            self.__deselect_packages(pkg_manager)
-            self.__localinst_packages(pkg_manager)
-            self.__check_packages(pkg_manager)
+            self.__mark_packages(pkg_manager)
 
             BOOT_SAFEGUARD = 256L * 1024 * 1024 # 256M
             checksize = self._root_fs_avail
@@ -1097,6 +1119,46 @@ class BaseImageCreator(object):
             except:
                 pass
 
+    def get_install_plan(self, cachedir = None):
+        """Resolve the packages to install without creating the image.
+
+        Nothing is mounted or downloaded, the repo metadata is fetched into
+        the cache directory and the transaction is resolved in an empty
+        install root. Return a dict of the packages of the transaction with
+        their sizes, and whether they are cached.
+
+        cachedir -- the cache directory, as for mount()
+
+        """
+        self.__ensure_builddir()
+        fs.makedirs(self._instroot)
+        self.get_cachedir(cachedir)
+
+        pkg_manager = self.__setup_pkg_manager()
+        try:
+            self.__mark_packages(pkg_manager)
+            packages = pkg_manager.planInstall()
+        finally:
+            pkg_manager.close()
+
+        missed = [pkg for pkg in packages if not pkg['cached']]
+        return {'name': self.name,
+                'arch': self.target_arch,
+                'packages': packages,
+                'count': len(packages),
+                'cached': len(packages) - len(missed),
+                'download_size': sum(pkg['download_size'] for pkg in missed),
+                'install_size': sum(pkg['install_size'] for pkg in packages),
+               }
+
+    def print_install_plan(self, cachedir = None):
+        plan = self.get_install_plan(cachedir)
+        msger.info("Packages: %d Total, %d Cached, %d Missed" \
+                   % (plan['count'], plan['cached'],
+                      plan['count'] - plan['cached']))
+        msger.raw(json.dumps(plan, indent = 2, sort_keys = True,
+                             separators = (',', ': ')))
+
     def postinstall(self):
         self.copy_attachment()
 
@@ -1197,11 +1259,23 @@ class BaseImageCreator(object):
             msger.info("Launching shell. Exit to continue.")
             subprocess.call(["/bin/bash"], preexec_fn = self._chroot)
 
+    def _checksum_names(self):
+        """ Return the digests needed for the output files, they are all
+        calculated together the first time one of them is asked for.
+        """
+        names = []
+        if self._genchecksum:
+            names.append('md5')
+        if getattr(self, 'release', None) is not None:
+            names.extend(['md5', 'sha1', 'sha256'])
+
+        return sorted(set(names))
+
     def do_genchecksum(self, image_name):
         if not self._genchecksum:
             return
 
-        md5sum = misc.get_md5sum(image_name)
+        md5sum = misc.get_hashes(image_name, self._checksum_names())['md5']
         with open(image_name + ".md5sum", "w") as f:
             f.write("%s  %s" % (md5sum, os.path.basename(image_name)))
         self.outimage.append(image_name+".md5sum")
@@ -1330,31 +1404,31 @@ class BaseImageCreator(object):
             outimages.append(_rpath(newf))
 
         # generate MD5SUMS SHA1SUMS SHA256SUMS
-        def generate_hashsum(hash_name, hash_method):
-            with open(_rpath(hash_name), "w") as wf:
-                for f in os.listdir(destdir):
-                    if f.endswith('SUMS'):
-                        continue
-
-                    if os.path.isdir(os.path.join(destdir, f)):
-                        continue
-
-                    hash_value = hash_method(_rpath(f))
-                    # There needs to be two spaces between the sum and
-                    # filepath to match the syntax with md5sum,sha1sum,
-                    # sha256sum. This way also *sum -c *SUMS can be used.
-                    wf.write("%s  %s\n" % (hash_value, f))
-
-            outimages.append("%s/%s" % (destdir, hash_name))
-
         hash_dict = {
-                     'MD5SUMS'    : misc.get_md5sum,
-                     'SHA1SUMS'   : misc.get_sha1sum,
-                     'SHA256SUMS' : misc.get_sha256sum
+                     'MD5SUMS'    : 'md5',
+                     'SHA1SUMS'   : 'sha1',
+                     'SHA256SUMS' : 'sha256'
                     }
 
-        for k, v in hash_dict.items():
-            generate_hashsum(k, v)
+        sums = dict((k, []) for k in hash_dict)
+        for f in os.listdir(destdir):
+            if f.endswith('SUMS'):
+                continue
+
+            if os.path.isdir(os.path.join(destdir, f)):
+                continue
+
+            hashes = misc.get_hashes(_rpath(f), hash_dict.values())
+            for k, v in hash_dict.items():
+                # There needs to be two spaces between the sum and
+                # filepath to match the syntax with md5sum,sha1sum,
+                # sha256sum. This way also *sum -c *SUMS can be used.
+                sums[k].append("%s  %s\n" % (hashes[v], f))
+
+        for k in hash_dict:
+            with open(_rpath(k), "w") as wf:
+                wf.writelines(sums[k])
+            outimages.append("%s/%s" % (destdir, k))
 
         # Filter out the nonexist file
         for fp in outimages[:]:
@@ -18,12 +18,15 @@
 import os
 import glob
 import shutil
+import multiprocessing
+import multiprocessing.dummy
 
 from mic import kickstart, msger
 from mic.utils.errors import CreatorError, MountError
 from mic.utils import misc, runner, fs_related as fs
 from mic.imager.baseimager import BaseImageCreator
-from mic.archive import packing, compressing
+from mic.utils.imagesink import ImageSink
+from mic.archive import packing
 
 
 # The maximum string length supported for LoopImageCreator.fslabel
@@ -103,19 +106,23 @@ class LoopImageCreator(BaseImageCreator):
 
     def __init__(self, creatoropts=None, pkgmgr=None,
                  compress_image=None,
-                 shrink_image=False):
+                 shrink_image=False,
+                 parallel_stage=False):
         """Initialize a LoopImageCreator instance.
 
         This method takes the same arguments as ImageCreator.__init__()
         with the addition of:
 
         fslabel -- A string used as a label for any filesystems created.
+        parallel_stage -- Whether to resparse, compress and move the
+                          partition images in parallel.
         """
 
         BaseImageCreator.__init__(self, creatoropts, pkgmgr)
 
         self.compress_image = compress_image
         self.shrink_image = shrink_image
+        self.parallel_stage = parallel_stage
 
         self.__fslabel = None
         self.fslabel = self.name
@@ -291,11 +298,10 @@ class LoopImageCreator(BaseImageCreator):
                 be used (or 4GiB if not specified in the kickstart).
         """
         minsize = 0
-        for item in self._instloops:
+        minsizes = self._map_instloops(lambda item: item['loop'].resparse(size))
+        for item, itemsize in zip(self._instloops, minsizes):
             if item['name'] == self._img_name:
-                minsize = item['loop'].resparse(size)
-            else:
-                item['loop'].resparse(size)
+                minsize = itemsize
 
         return minsize
 
@@ -380,31 +386,64 @@ class LoopImageCreator(BaseImageCreator):
             except:
                 pass
 
+    def _map_instloops(self, func):
+        """ Call 'func' for every item of self._instloops and return the
+        results in the same order. Partition images are independent files,
+        with parallel_stage they are processed at the same time, as most of
+        the work is done by external tools and by the compressors.
+        """
+        try:
+            workers = min(len(self._instloops), multiprocessing.cpu_count())
+        except NotImplementedError:
+            workers = 1
+        if not self.parallel_stage or workers < 2:
+            return map(func, self._instloops)
+
+        pool = multiprocessing.dummy.Pool(workers)
+        try:
+            return pool.map(func, self._instloops)
+        finally:
+            pool.close()
+            pool.join()
+
     def _stage_final_image(self):
 
         if self.pack_to or self.shrink_image:
-            self._resparse(0)
+            size = 0
         else:
-            self._resparse()
+            size = None
+
+        def _stage_instloop(item):
+            item['loop'].resparse(size)
 
-        for item in self._instloops:
             imgfile = os.path.join(self._imgdir, item['name'])
             if item['fstype'] == "ext4":
                 runner.show('/sbin/tune2fs -O ^huge_file,extents,uninit_bg %s '
                             % imgfile)
+
+            # compress and checksum the image with one read of its data
+            if not self.pack_to:
+                ImageSink(imgfile, self.compress_image,
+                          self._checksum_names()).stage(self._outdir)
+            elif self.compress_image:
+                ImageSink(imgfile, self.compress_image).stage(self._imgdir)
+
+        self._map_instloops(_stage_instloop)
+
+        for item in self._instloops:
             self.image_files.setdefault('partitions', {}).update(
                     {item['mountpoint']: item['label']})
             if self.compress_image:
-                compressing(imgfile, self.compress_image)
                 self.image_files.setdefault('image_files', []).append(
                                 '.'.join([item['name'], self.compress_image]))
             else:
                 self.image_files.setdefault('image_files', []).append(item['name'])
 
         if not self.pack_to:
+            # the other files, e.g. attachments
             for item in os.listdir(self._imgdir):
-                shutil.move(os.path.join(self._imgdir, item),
-                            os.path.join(self._outdir, item))
+                ImageSink(os.path.join(self._imgdir, item), None,
+                          self._checksum_names()).stage(self._outdir)
         else:
             msger.info("Pack all loop images together to %s" % self.pack_to)
             dstfile = os.path.join(self._outdir, self.pack_to)
@@ -24,7 +24,8 @@ from mic.utils import fs_related, runner, misc
 from mic.utils.partitionedfs import PartitionedMount
 from mic.utils.errors import CreatorError, MountError
 from mic.imager.baseimager import BaseImageCreator
-from mic.archive import packing, compressing
+from mic.utils.imagesink import ImageSink
+from mic.archive import packing
 
 class RawImageCreator(BaseImageCreator):
     """Installs a system into a file containing a partitioned disk image.
@@ -57,6 +58,8 @@ class RawImageCreator(BaseImageCreator):
         self.appliance_release = None
         self.compress_image = compress_image
         self.bmap_needed = generate_bmap
+        # image path -> block map file, generated while staging
+        self._bmap_files = {}
         self._need_extlinux = not kickstart.use_installerfw(self.ks, "bootloader")
         #self.getsource = False
         #self.listpkg = False
@@ -461,10 +464,6 @@ class RawImageCreator(BaseImageCreator):
 
         if self.compress_image:
             for imgfile in os.listdir(self.__imgdir):
-                if imgfile.endswith('.raw') or imgfile.endswith('bin'):
-                    imgpath = os.path.join(self.__imgdir, imgfile)
-                    msger.info("Compressing image %s" % imgfile)
-                    compressing(imgpath, self.compress_image)
                 if imgfile.endswith('.raw') and not self.pack_to:
                     for disk in self.__disks.keys():
                         if imgfile.find(disk) != -1:
@@ -474,18 +473,32 @@ class RawImageCreator(BaseImageCreator):
                             self.image_files.setdefault('image_files',
                                     []).append(imgname)
 
+        # compress, checksum and generate the block map of each image with
+        # one read of the image data
+        if self.pack_to:
+            stagedir = self.__imgdir
+            hash_names = ()
+        else:
+            msger.debug("moving disks to stage location")
+            stagedir = self._outdir
+            hash_names = self._checksum_names()
+
+        for imgfile in os.listdir(self.__imgdir):
+            imgpath = os.path.join(self.__imgdir, imgfile)
+            compress = None
+            if self.compress_image and \
+               (imgfile.endswith('.raw') or imgfile.endswith('bin')):
+                compress = self.compress_image
+            bmap = self._bmap_files.get(imgpath)
+            if stagedir == self.__imgdir and not (compress or bmap):
+                continue
+            ImageSink(imgpath, compress, hash_names, bmap).stage(stagedir)
+
         if self.pack_to:
             dst = os.path.join(self._outdir, self.pack_to)
             msger.info("Pack all raw images to %s" % dst)
             packing(dst, self.__imgdir)
             self.image_files.update({'image_files': self.pack_to})
-        else:
-            msger.debug("moving disks to stage location")
-            for imgfile in os.listdir(self.__imgdir):
-                src = os.path.join(self.__imgdir, imgfile)
-                dst = os.path.join(self._outdir, imgfile)
-                msger.debug("moving %s to %s" % (src,dst))
-                shutil.move(src,dst)
 
         self._write_image_xml()
 
@@ -541,12 +554,12 @@ class RawImageCreator(BaseImageCreator):
                 xml += "    <disk file='%s' use='system' format='%s'>\n" \
                        % (full_name, self.__disk_format)
 
-                hashes = misc.calc_hashes(diskpath, ('sha1', 'sha256'))
+                hashes = misc.get_hashes(diskpath, self._checksum_names())
 
                 xml +=  "      <checksum type='sha1'>%s</checksum>\n" \
-                        % hashes[0]
+                        % hashes['sha1']
                 xml += "      <checksum type='sha256'>%s</checksum>\n" \
-                       % hashes[1]
+                       % hashes['sha256']
                 xml += "    </disk>\n"
         else:
             for name in self.__disks.keys():
@@ -562,6 +575,12 @@ class RawImageCreator(BaseImageCreator):
         cfg.write(xml)
         cfg.close()
 
+    def _checksum_names(self):
+        names = super(RawImageCreator, self)._checksum_names()
+        if self.checksum is True:
+            names = sorted(set(names + ['sha1', 'sha256']))
+        return names
+
     def generate_bmap(self):
         """ Generate block map file for the image. The idea is that while disk
         images we generate may be large (e.g., 4GiB), they may actually contain
@@ -573,12 +592,14 @@ class RawImageCreator(BaseImageCreator):
         This function generates the block map file for an arbitrary image that
         mic has generated. The block map file is basically an XML file which
         contains a list of blocks which have to be copied to the target device.
-        The other blocks are not used and there is no need to copy them. """
+        The other blocks are not used and there is no need to copy them.
+
+        The map files are written when the images are staged, from the same
+        read of the image data as the compression and the checksums. """
 
         if self.bmap_needed is None:
             return
 
-        from mic.utils import BmapCreate
         msger.info("Generating the map file(s)")
 
         for name in self.__disks.keys():
@@ -586,15 +607,7 @@ class RawImageCreator(BaseImageCreator):
             bmap_file = self._full_path(self._outdir, name, "bmap")
             self.image_files.setdefault(name, {}).update({'bmap': \
                                             os.path.basename(bmap_file)})
-
-            msger.debug("Generating block map file '%s'" % bmap_file)
-
-            try:
-                creator = BmapCreate.BmapCreate(image, bmap_file)
-                creator.generate()
-                del creator
-            except BmapCreate.Error as err:
-                raise CreatorError("Failed to create bmap file: %s" % str(err))
+            self._bmap_files[image] = bmap_file
 
     def create_manifest(self):
         if self.compress_image:
@@ -43,6 +43,7 @@ __ALL__ = [
     'disable_interactive',
     'enable_logstderr',
     'disable_logstderr',
+    'log_to_stderr',
     'raw',
     'debug',
     'verbose',
@@ -305,6 +306,12 @@ class MicLogger(logging.Logger):
         if self.logfile:
             self._allhandlers['logfile'].restore_stderr()
 
+    def log_to_stderr(self):
+        """ Log the messages of all levels to stderr, only the raw text
+            messages are left on stdout
+        """
+        self._allhandlers['stdout'].stream = sys.stderr
+
     def verbose(self, msg, *args, **kwargs):
         """ Log a message with level VERBOSE """
         if self.isEnabledFor(VERBOSE):
@@ -419,6 +426,10 @@ def disable_logstderr():
     """ Stop to log all error message on the MIC logger """
     LOGGER.disable_logstderr()
 
+def log_to_stderr():
+    """ Leave stdout to the raw text messages of the MIC logger """
+    LOGGER.log_to_stderr()
+
 
 # add two level to the MIC logger: 'VERBOSE', 'RAWTEXT'
 logging.addLevelName(VERBOSE, 'VERBOSE')
@@ -74,6 +74,19 @@ class ImagerPlugin(_Plugin):
             else:
                 raise errors.Abort("Canceled")
 
+    @classmethod
+    def print_plan(cls, creator, creatoropts):
+        """ Print the install plan of 'creator' for --plan, return True if
+        it is printed, then no image is created """
+        if not creatoropts['plan']:
+            return False
+
+        try:
+            creator.print_install_plan(creatoropts["cachedir"])
+        finally:
+            creator.cleanup()
+        return True
+
     def do_create(self):
         pass
 
@@ -26,7 +26,7 @@ import ctypes
 
 from mic import bootstrap, msger
 from mic.conf import configmgr
-from mic.utils import errors, proxy
+from mic.utils import errors, proxy, pkgstore
 from mic.utils.fs_related import find_binary_path, makedirs
 from mic.chroot import setup_chrootenv, cleanup_chrootenv, ELF_arch
 
@@ -95,6 +95,11 @@ def bootstrap_mic(argv=None):
     else:
         optlist = []
 
+    pkgstore.set_package_store(cropts['package_store'])
+    if cropts['package_store']:
+        # it is bind mounted for mic in bootstrap
+        makedirs(cropts['package_store'])
+
     try:
         msger.info("Creating %s bootstrap ..." % distro)
         bsenv.create(cropts['repomd'], pkglist, optlist)
@@ -136,6 +141,7 @@ def get_bindmounts(cropts):
                   cropts['cachedir'],
                   cropts['outdir'],
                   cropts['local_pkgs_path'],
+                  cropts['package_store'],
                 ]
     bindfiles = [
                   cropts['logfile'],
@@ -310,12 +310,17 @@ class BmapCreate(object):
 
         return hash_obj.hexdigest()
 
-    def generate(self, include_checksums=True):
+    def generate(self, include_checksums=True, range_chksums=None):
         """
         Generate bmap for the image file. If 'include_checksums' is 'True',
-        also generate checksums for block ranges.
+        also generate checksums for block ranges. The 'range_chksums'
+        dictionary may provide the already known checksums of the ranges,
+        keyed by the '(first, last)' block numbers of the range.
         """
 
+        if range_chksums is None:
+            range_chksums = {}
+
         # Save image file position in order to restore it at the end
         image_pos = self._f_image.tell()
 
@@ -327,7 +332,9 @@ class BmapCreate(object):
         for first, last in self.filemap.get_mapped_ranges(0, self.blocks_cnt):
             self.mapped_cnt += last - first + 1
             if include_checksums:
-                chksum = self._calculate_chksum(first, last)
+                chksum = range_chksums.get((first, last))
+                if chksum is None:
+                    chksum = self._calculate_chksum(first, last)
                 chksum = " chksum=\"%s\"" % chksum
             else:
                 chksum = ""
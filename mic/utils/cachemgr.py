@@ -0,0 +1,272 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Size limit of the cache directory, with the least recently used entries
+evicted first.
+
+The entries of a cache directory are the package files and the metadata
+of each repo: cachedir/<repo>, and the zypp caches cachedir/raw/<repo> and
+cachedir/solv/<repo>, which are evicted together under the zypp.lock of
+the repo. Each resolved transaction of zypp in cachedir/resolver is an
+entry of its own. The packages of the package store are entries too, a
+package linked into the cache and the store is one entry; a package other
+cache directories link to isn't an entry of this one.
+
+The access time of an entry is set explicitly with touch() when a build
+uses it, so it doesn't depend on the atime options of the file system. It
+is the atime of a package or transaction file, and the mtime of a stamp file in a
+metadata directory, as walking the directory updates its atime.
+Entries used in the last hour or since this process started are never
+evicted, other builds may be using them.
+"""
+
+import os
+import time
+import fcntl
+import shutil
+
+from mic import msger
+
+# the size limit of the cache directory in bytes, 0 for no limit
+_cache_size = 0
+
+# the entries used after this time are kept, see _keep_since()
+_start_time = time.time()
+
+# the top directories of the cache which aren't repo metadata
+_NON_REPO_DIRS = ("packages", "raw", "solv", "etc", "resolver")
+
+# the stamp file of the access time of a metadata directory
+_ACCESS_STAMP = ".mic-access"
+
+# the files of cachedir/<repo> telling it is the metadata of a repo
+_REPO_FILES = ("repomd.xml", "repodata/repomd.xml", "zypp.lock")
+
+def set_cache_size(size):
+    """ Set the size limit of the cache directory in bytes, 0 for none """
+    global _cache_size
+    _cache_size = size or 0
+
+def get_cache_size():
+    return _cache_size
+
+def touch(path):
+    """ Record that 'path', a cache file or directory, is used now """
+    try:
+        if os.path.isdir(path):
+            open(os.path.join(path, _ACCESS_STAMP), "a").close()
+            os.utime(os.path.join(path, _ACCESS_STAMP), None)
+        else:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except (IOError, OSError):
+        pass
+
+def _dir_atime(path):
+    try:
+        return os.stat(os.path.join(path, _ACCESS_STAMP)).st_mtime
+    except OSError:
+        return os.stat(path).st_mtime
+
+class CacheEntry(object):
+    """ A package file, the metadata directories of a repo, or a resolved
+    transaction file """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.paths = []
+        self.size = 0
+        self.atime = 0
+        self.nlink = 1
+        # the lock held while the entry is updated, see _remove()
+        self.lockname = None
+
+def _dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def _scan_packages(topdir, packages):
+    for root, dirs, files in os.walk(topdir):
+        for name in files:
+            if not name.endswith(".rpm"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            # the links of one file make one entry
+            key = (stat.st_dev, stat.st_ino)
+            if key not in packages:
+                packages[key] = CacheEntry("package", name)
+                packages[key].size = stat.st_size
+                packages[key].atime = stat.st_atime
+                packages[key].nlink = stat.st_nlink
+            packages[key].paths.append(path)
+
+def scan(cachedir, package_store = None):
+    """ Return the list of the entries of 'cachedir' and of the package
+    store 'package_store'
+    """
+    packages = {}
+    for topdir in (os.path.join(cachedir, "packages"), package_store):
+        if topdir and os.path.isdir(topdir):
+            _scan_packages(topdir, packages)
+
+    # the package files other cache directories link to belong to them too
+    entries = [entry for entry in packages.values()
+               if entry.nlink <= len(entry.paths)]
+
+    repos = {}
+    # raw/<repo> and solv/<repo> go first, to be removed before the
+    # directory of their lock
+    for topdir in (os.path.join(cachedir, "raw"),
+                   os.path.join(cachedir, "solv"),
+                   cachedir):
+        if not os.path.isdir(topdir):
+            continue
+        for name in os.listdir(topdir):
+            path = os.path.join(topdir, name)
+            if not os.path.isdir(path) or os.path.islink(path):
+                continue
+            if topdir == cachedir and not _is_repo_dir(name, path):
+                continue
+            if name not in repos:
+                repos[name] = CacheEntry("metadata", name)
+                repos[name].lockname = os.path.join(cachedir, name,
+                                                    "zypp.lock")
+            entry = repos[name]
+            entry.paths.append(path)
+            entry.size += _dir_size(path)
+            entry.atime = max(entry.atime, _dir_atime(path))
+
+    resolver = os.path.join(cachedir, "resolver")
+    if os.path.isdir(resolver):
+        for name in os.listdir(resolver):
+            # the others are the temporary files of the ones being written
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(resolver, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            entry = CacheEntry("transaction", name)
+            entry.paths.append(path)
+            entry.size = stat.st_size
+            entry.atime = stat.st_atime
+            entries.append(entry)
+
+    return entries + repos.values()
+
+def _is_repo_dir(name, path):
+    if name in _NON_REPO_DIRS:
+        return False
+    for fname in _REPO_FILES:
+        if os.path.exists(os.path.join(path, fname)):
+            return True
+    return False
+
+def _keep_since():
+    return min(_start_time, time.time() - 3600)
+
+def _remove_paths(entry):
+    for path in entry.paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors = True)
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def _remove(entry):
+    """ Remove the files of 'entry', return False if it is in use """
+    # zypp holds this lock while it updates any of the caches of the repo
+    if not entry.lockname or not os.path.exists(entry.lockname):
+        _remove_paths(entry)
+        return True
+
+    lockfile = open(entry.lockname, "a")
+    try:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        _remove_paths(entry)
+    finally:
+        lockfile.close()
+
+    return True
+
+def prune(entries, size):
+    """ Evict the least recently used 'entries' until they take up to 'size'
+    bytes. Return the (number of entries, bytes) evicted.
+    """
+    total = sum(entry.size for entry in entries)
+    keep_since = _keep_since()
+    count = freed = 0
+    for entry in sorted(entries, key = lambda entry: entry.atime):
+        if total <= size:
+            break
+        if entry.atime >= keep_since:
+            continue
+        if not _remove(entry):
+            continue
+        msger.verbose("evicted %s from the cache: %s"
+                      % (entry.kind, entry.paths[0]))
+        total -= entry.size
+        freed += entry.size
+        count += 1
+
+    return count, freed
+
+def make_room(cachedir, needed, package_store = None):
+    """ Evict entries of 'cachedir' before 'needed' bytes are downloaded
+    into it, so it stays in the size limit and the file system has room
+    for the download.
+    """
+    if not os.path.isdir(cachedir):
+        return
+
+    vfstat = os.statvfs(cachedir)
+    avail = vfstat.f_bavail * vfstat.f_bsize
+    if not _cache_size and avail >= needed:
+        return
+
+    entries = scan(cachedir, package_store)
+    total = sum(entry.size for entry in entries)
+    size = total
+    if _cache_size:
+        size = max(0, _cache_size - needed)
+    if avail < needed:
+        size = min(size, total - (needed - avail))
+    if total <= size:
+        return
+
+    count, freed = prune(entries, size)
+    if count:
+        # misc imports this module
+        from mic.utils.misc import human_size
+        msger.info("Evicted %d cached entries, %s freed"
+                   % (count, human_size(freed)))
@@ -19,6 +19,7 @@
 from __future__ import with_statement
 import os
 import sys
+import re
 import errno
 import stat
 import random
@@ -88,6 +89,20 @@ def resize2fs(fs, size):
     else:
         return runner.show([resize2fs, fs, "%sK" % (size / 1024,)])
 
+def resize2fs_estimate(fs):
+    """ Return the minimal size of filesystem 'fs' in blocks as estimated
+    by 'resize2fs -P', or None if the estimate isn't available
+    """
+    resize2fs = find_binary_path("resize2fs")
+    rc, out = runner.runtool([resize2fs, '-P', fs], catch=3)
+    if rc != 0:
+        return None
+
+    m = re.search("minimum size of the filesystem:\s*(\d+)", out)
+    if not m:
+        return None
+    return int(m.group(1))
+
 class BindChrootMount:
     """Represents a bind mount of a directory into a chroot."""
     def __init__(self, src, chroot, dest = None, option = None):
@@ -503,12 +518,32 @@ class ExtDiskMount(DiskMount):
         msger.info("Resizing filesystem to minimal ...")
         self.__fsck()
 
+        bot = 0
+        top = self.__get_size_from_filesystem()
+
+        #
+        # Start from the minimal size resize2fs estimates, it is normally
+        # accepted at once, otherwise try once more with some headroom.
+        # The filesystem is already minimal if that isn't below its size
+        #
+        blocks = resize2fs_estimate(self.disk.lofile)
+        if blocks:
+            size = blocks * self.blocksize
+            for t in (size, size + max(size / 50, 1024 * 1024)):
+                t -= t % self.blocksize
+                if t >= top:
+                    return top
+                if not resize2fs(self.disk.lofile, t):
+                    return t
+                # resize2fs refused t, the minimal size is above it
+                bot = t
+
+            msger.debug("resize2fs estimate failed, searching minimal size")
+
         #
         # Use a binary search to find the minimal size
         # we can resize the image to
         #
-        bot = 0
-        top = self.__get_size_from_filesystem()
         while top != (bot + 1):
             t = bot + ((top - bot) / 2)
 
@@ -4,7 +4,9 @@ import os
 import sys
 import fcntl
 import struct
+import itertools
 import termios
+import multiprocessing
 
 from mic import msger
 from mic.utils import runner
@@ -30,15 +32,23 @@ def myurlgrab(url, filename, proxies, progress_obj = None):
             runner.show(['cp', '-f', filepath, filename])
 
     else:
+        # packages never change under the same name, only the metadata
+        # must not come from a stale cache on the way
+        if url.endswith('.rpm'):
+            headers = ()
+        else:
+            headers = (('Pragma', 'no-cache'),)
+
         try:
             # cast url to str here, sometimes it can be unicode,
             # but pycurl only accept str
-            filename = g.urlgrab(url=str(url),
+            url = str(url)
+            filename = g.urlgrab(url=url,
                                  filename=filename,
                                  ssl_verify_host=False,
                                  ssl_verify_peer=False,
                                  proxies=proxies,
-                                 http_headers=(('Pragma', 'no-cache'),),
+                                 http_headers=headers,
                                  quote=0,
                                  progress_obj=progress_obj)
         except grabber.URLGrabError, err:
@@ -54,6 +64,147 @@ def myurlgrab(url, filename, proxies, progress_obj = None):
 
     return filename
 
+def myurlopen(url, proxies):
+    """ Open 'url' for reading, the data is read as it comes off the
+    network instead of being fetched to a file first
+    """
+    if url.startswith("file:/"):
+        filepath = "/%s" % url.replace("file:", "").lstrip('/')
+        try:
+            return open(filepath, "rb")
+        except IOError:
+            raise CreatorError("URLGrabber error: can't find file %s" % url)
+
+    g = grabber.URLGrabber()
+    try:
+        url = str(url)
+        return g.urlopen(url,
+                         ssl_verify_host=False,
+                         ssl_verify_peer=False,
+                         proxies=proxies,
+                         http_headers=(('Pragma', 'no-cache'),),
+                         quote=0)
+    except grabber.URLGrabError, err:
+        tmp = SafeURL(url)
+        msg = str(err)
+
+        if msg.find(url) < 0:
+            msg += ' on %s' % tmp
+        else:
+            msg = msg.replace(url, tmp)
+
+        raise CreatorError(msg)
+
+def _grab_one(job):
+    """ Fetch one (url, filename, proxies) job in a pool worker
+
+    The file is fetched into a '.part' name and renamed when complete, so
+    an interrupted transfer never leaves a truncated file in the cache.
+    """
+    url, filename, proxies = job
+    partname = filename + '.part'
+    try:
+        path = myurlgrab(url, partname, proxies, _SilentProgress())
+        if path == partname:
+            os.rename(partname, filename)
+            path = filename
+    except CreatorError, err:
+        if os.path.exists(partname):
+            os.unlink(partname)
+        return (None, str(err))
+    except KeyboardInterrupt:
+        return (None, 'interrupted')
+
+    return (path, None)
+
+def _grab_indexed(task):
+    """ Fetch the job of an (index, grab function, job) task in a worker """
+    index, grab, job = task
+    path, err = grab(job)
+    return (index, path, err)
+
+class _AsyncGrab(object):
+    """ The transfers started by myurlgrab_async() """
+    def __init__(self, jobs, workers, progress_obj, optional, grab):
+        self._jobs = jobs
+        self._progress = progress_obj
+        self._optional = optional
+        self._pool = None
+
+        workers = min(workers, len(jobs))
+        if workers > 1:
+            try:
+                self._pool = multiprocessing.Pool(workers)
+            except (OSError, ImportError), err:
+                msger.warning("cannot start download workers, "
+                              "fallback to serial download: %s" % err)
+
+        tasks = [(index, grab, job) for index, job in enumerate(jobs)]
+        if self._pool is None:
+            self._results = itertools.imap(_grab_indexed, tasks)
+        else:
+            self._results = self._pool.imap_unordered(_grab_indexed, tasks)
+
+    def __iter__(self):
+        for index, path, err in self._results:
+            job = self._jobs[index]
+            if err and job[1] in self._optional:
+                msger.debug("\ncan't get %s: %s" % (SafeURL(job[0]), err))
+                yield (index, None)
+                continue
+            if err:
+                raise CreatorError(err)
+            self._progress.start(path, job[0])
+            self._progress.end()
+            yield (index, path)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+def myurlgrab_async(jobs, workers, progress_obj = None, optional = (),
+                    grab = None):
+    """ Start fetching a list of (url, filename, proxies) jobs
+
+    The transfers run in a pool of 'workers' processes while the caller goes
+    on. Iterating the returned object gives the (index in 'jobs', path) of
+    each job as it completes, the path is None for a failed job whose
+    filename is in 'optional'. It must be closed when done with.
+    See myurlgrab_many() for 'grab'.
+    """
+    if progress_obj is None:
+        progress_obj = TextProgress(len(jobs))
+    if grab is None:
+        grab = _grab_one
+
+    return _AsyncGrab(jobs, workers, progress_obj, optional, grab)
+
+def myurlgrab_many(jobs, workers, progress_obj = None, optional = (),
+                   grab = None):
+    """ Fetch a list of (url, filename, proxies) jobs
+
+    Up to 'workers' transfers are kept in flight by a pool of processes,
+    urlgrabber shares one curl handle per process and can't be used from
+    threads. Progress is reported from the parent as each file completes.
+    Return the list of fetched file paths in the order of 'jobs', the path
+    is None for a failed job whose filename is in 'optional'.
+
+    'grab' fetches one job in a worker in place of the default, it must be
+    a module level function returning (path, error message) like _grab_one.
+    Jobs may carry more items after the first three for it.
+    """
+    paths = [None] * len(jobs)
+    transfers = myurlgrab_async(jobs, workers, progress_obj, optional, grab)
+    try:
+        for index, path in transfers:
+            paths[index] = path
+    finally:
+        transfers.close()
+
+    return paths
+
 def terminal_width(fd=1):
     """ Get the real terminal width """
     try:
@@ -66,6 +217,17 @@ def terminal_width(fd=1):
 def truncate_url(url, width):
     return os.path.basename(url)[0:width]
 
+class _SilentProgress(object):
+    """ Progress object for pool workers, the parent does the reporting """
+    def start(self, *args, **kwargs):
+        pass
+
+    def update(self, *args):
+        pass
+
+    def end(self, *args):
+        pass
+
 class TextProgress(object):
     # make the class as singleton
     _instance = None
@@ -0,0 +1,197 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+This module implements the last stage of writing an image: moving or
+compressing it to the output directory. Everything which needs the image
+data at that point - the digests of the staged file, the compressor and the
+checksums of the mapped ranges in the block map file - is fed from a single
+sequential read of the image, instead of each of them reading it again.
+The holes of the sparse images are not read at all.
+"""
+
+import os
+import shutil
+import hashlib
+
+from mic import msger
+from mic.archive import open_compressor, read_sparse
+from mic.utils import misc
+from mic.utils.errors import CreatorError
+
+# the checksum type used for the block map file
+BMAP_CHKSUM_TYPE = "sha256"
+
+class _HashingFile(object):
+    """ Write to 'fileobj' and update the 'hashes' on the way """
+    def __init__(self, fileobj, hashes):
+        self._fileobj = fileobj
+        self._hashes = hashes
+
+    def write(self, data):
+        for hash_obj in self._hashes:
+            hash_obj.update(data)
+        self._fileobj.write(data)
+
+class _RangeHashes(object):
+    """ Checksums of the mapped block ranges of an image, calculated from
+    the image data read in sequence.
+    """
+    def __init__(self, ranges, block_size, chksum_type):
+        self._ranges = ranges
+        self._block_size = block_size
+        self._chksum_type = chksum_type
+        self._index = 0
+        self._hash_obj = None
+        self.chksums = {}
+
+    def update(self, offset, data):
+        end = offset + len(data)
+        while self._index < len(self._ranges):
+            first, last = self._ranges[self._index]
+            start = first * self._block_size
+            stop = (last + 1) * self._block_size
+            if start >= end:
+                break
+
+            if self._hash_obj is None:
+                self._hash_obj = hashlib.new(self._chksum_type)
+            self._hash_obj.update(data[max(start, offset) - offset:
+                                       min(stop, end) - offset])
+            if stop > end:
+                break
+
+            self._finish_range()
+
+    def _finish_range(self):
+        if self._hash_obj is None:
+            self._hash_obj = hashlib.new(self._chksum_type)
+        self.chksums[self._ranges[self._index]] = self._hash_obj.hexdigest()
+        self._hash_obj = None
+        self._index += 1
+
+    def close(self):
+        # ranges running past the end of the image end with the file
+        while self._index < len(self._ranges):
+            self._finish_range()
+
+class ImageSink(object):
+    """ Stage one image file into an output directory
+
+    'compress_format' is the compression format of the staged file, None to
+    stage it as is. 'hash_names' are the digests of the staged file to
+    calculate, they are remembered by misc.get_hashes(). 'bmap' is the path
+    of the block map file to generate for the image, None for no block map.
+    """
+    def __init__(self, image, compress_format = None, hash_names = (),
+                 bmap = None):
+        self.image = image
+        self.compress_format = compress_format
+        self.hash_names = list(hash_names)
+        self.bmap = bmap
+
+    def _staged_path(self, destdir):
+        name = os.path.basename(self.image)
+        if self.compress_format:
+            name = "%s.%s" % (name, self.compress_format)
+        return os.path.join(destdir, name)
+
+    def stage(self, destdir):
+        """ Stage the image into 'destdir' and return the staged path, the
+        source image is removed.
+        """
+        dst = self._staged_path(destdir)
+        bmap_creator = None
+        range_hashes = None
+
+        if self.bmap:
+            from mic.utils import BmapCreate
+            msger.debug("Generating block map file '%s'" % self.bmap)
+            try:
+                bmap_creator = BmapCreate.BmapCreate(self.image, self.bmap,
+                                                     BMAP_CHKSUM_TYPE)
+            except BmapCreate.Error, err:
+                raise CreatorError("Failed to create bmap file: %s" % err)
+            ranges = list(bmap_creator.filemap.get_mapped_ranges(0,
+                                                    bmap_creator.blocks_cnt))
+            range_hashes = _RangeHashes(ranges, bmap_creator.block_size,
+                                        BMAP_CHKSUM_TYPE)
+
+        if not (self.compress_format or self.hash_names or range_hashes):
+            if dst != self.image:
+                shutil.move(self.image, dst)
+            return dst
+
+        hashes = [hashlib.new(name) for name in self.hash_names]
+
+        if self.compress_format:
+            msger.info("Compressing image %s" % os.path.basename(self.image))
+            dst_tmp = dst + ".part"
+            fdst = open(dst_tmp, "wb")
+            sink = open_compressor(_HashingFile(fdst, hashes),
+                                   self.compress_format)
+        else:
+            fdst = None
+            sink = None
+
+        chunk_size = 1024 * 1024
+        offset = 0
+        staged = False
+        try:
+            with open(self.image, "rb") as fsrc:
+                for chunk in read_sparse(fsrc, chunk_size):
+                    if range_hashes:
+                        range_hashes.update(offset, chunk)
+                    if sink:
+                        sink.write(chunk)
+                    else:
+                        for hash_obj in hashes:
+                            hash_obj.update(chunk)
+                    offset += len(chunk)
+
+            if sink:
+                sink.close()
+                fdst.close()
+            staged = True
+        except (IOError, OSError), err:
+            raise CreatorError("Failed to stage image %s: %s"
+                               % (self.image, err))
+        finally:
+            if not staged and fdst:
+                # stop the compressor before removing its output
+                sink.abort()
+                fdst.close()
+                os.unlink(dst_tmp)
+
+        if range_hashes:
+            range_hashes.close()
+            try:
+                bmap_creator.generate(range_chksums=range_hashes.chksums)
+            except BmapCreate.Error, err:
+                raise CreatorError("Failed to create bmap file: %s" % err)
+            del bmap_creator
+
+        if self.compress_format:
+            os.rename(dst_tmp, dst)
+            os.unlink(self.image)
+        elif dst != self.image:
+            shutil.move(self.image, dst)
+
+        if hashes:
+            misc.set_hashes(dst, dict(zip(self.hash_names,
+                                          [h.hexdigest() for h in hashes])))
+        return dst
@@ -18,7 +18,12 @@
 from __future__ import with_statement
 import os
 import sys
+import ssl
+import json
+import zlib
 import time
+import base64
+import urllib2
 import tempfile
 import re
 import shutil
@@ -27,6 +32,7 @@ import hashlib
 import subprocess
 import platform
 import traceback
+import multiprocessing.dummy
 
 
 try:
@@ -43,11 +49,16 @@ xmlparse = cElementTree.parse
 from mic import msger
 from mic.utils.errors import CreatorError, SquashfsError
 from mic.utils.fs_related import find_binary_path, makedirs
-from mic.utils.grabber import myurlgrab
+from mic.archive import open_decompressor
+from mic.utils.grabber import myurlgrab, myurlgrab_many, myurlopen, \
+                              TextProgress
 from mic.utils.proxy import get_proxy_for
 from mic.utils import runner
 from mic.utils import rpmmisc
+from mic.utils import pkgstore
+from mic.utils import cachemgr
 from mic.utils.safeurl import SafeURL
+from mic.utils.Filemap import get_block_size
 
 
 RPM_RE  = re.compile("(.*)\.(.*) (.*)-(.*)")
@@ -199,18 +210,6 @@ def human_size(size):
     mant = float(size/math.pow(1024, expo))
     return "{0:.1f}{1:s}".format(mant, measure[expo])
 
-def get_block_size(file_obj):
-    """ Returns block size for file object 'file_obj'. Errors are indicated by
-    the 'IOError' exception. """
-
-    from fcntl import ioctl
-    import struct
-
-    # Get the block size of the host file-system for the image file by calling
-    # the FIGETBSZ ioctl (number 2).
-    binary_data = ioctl(file_obj, 2, struct.pack('I', 0))
-    return struct.unpack('I', binary_data)[0]
-
 def check_space_pre_cp(src, dst):
     """Check whether disk space is enough before 'cp' like
     operations, else exception will be raised.
@@ -258,14 +257,90 @@ def calc_hashes(file_path, hash_names, start = 0, end = None):
 
     return result
 
+# digests computed by get_hashes(), keyed by the identity of the file
+_HASHES_CACHE = {}
+
+def _hashes_cache_key(fpath):
+    st = os.stat(fpath)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def get_hashes(fpath, hash_names):
+    """ Return a dict of the 'hash_names' digests of file 'fpath'. All the
+    digests not known yet are calculated in one read of the file, and they
+    are remembered until the file changes, so asking for the same or other
+    already calculated digests later doesn't read the file again.
+    """
+    key = _hashes_cache_key(fpath)
+    hashes = _HASHES_CACHE.setdefault(key, {})
+
+    missing = [name for name in hash_names if name not in hashes]
+    if missing:
+        hashes.update(zip(missing, calc_hashes(fpath, missing)))
+
+    return dict((name, hashes[name]) for name in hash_names)
+
+def set_hashes(fpath, hashes):
+    """ Remember the digests in dict 'hashes' of file 'fpath', which were
+    calculated while the file was written, see get_hashes()
+    """
+    _HASHES_CACHE.setdefault(_hashes_cache_key(fpath), {}).update(hashes)
+
 def get_md5sum(fpath):
-    return calc_hashes(fpath, ('md5', ))[0]
+    return get_hashes(fpath, ('md5', ))['md5']
 
 def get_sha1sum(fpath):
-    return calc_hashes(fpath, ('sha1', ))[0]
+    return get_hashes(fpath, ('sha1', ))['sha1']
 
 def get_sha256sum(fpath):
-    return calc_hashes(fpath, ('sha256', ))[0]
+    return get_hashes(fpath, ('sha256', ))['sha256']
+
+def check_package_integrity(fpath, sumtype = None, checksum = None,
+                            size = None):
+    """ Check whether the package file 'fpath' is intact, returns 0 if it is
+    like 'rpm -K' does. With the checksum and the size of the package in the
+    repo metadata, they are checked in process, and the digest of the file is
+    remembered like get_hashes() does. Otherwise 'rpm -K' is run.
+    """
+    if size and os.path.getsize(fpath) != int(size):
+        return 1
+
+    if sumtype and checksum:
+        if sumtype == "sha":
+            sumtype = "sha1"
+        try:
+            digest = get_hashes(fpath, (sumtype, ))[sumtype]
+        except ValueError:
+            # not a digest hashlib knows
+            pass
+        else:
+            if digest == checksum:
+                return 0
+            return 1
+
+    return rpmmisc.checkRpmIntegrity('rpm', fpath)
+
+def check_packages_integrity(packages, jobs = None):
+    """ Check many package files with check_package_integrity() at the same
+    time, 'packages' is a list of tuples of its arguments. Hashing and
+    'rpm -K' don't hold the GIL, so the files are checked by 'jobs' threads,
+    one per CPU by default. Return the list of the results.
+    """
+    if jobs is None:
+        try:
+            jobs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            jobs = 1
+
+    jobs = min(jobs, len(packages))
+    if jobs < 2:
+        return [check_package_integrity(*args) for args in packages]
+
+    pool = multiprocessing.dummy.Pool(jobs)
+    try:
+        return pool.map(lambda args: check_package_integrity(*args), packages)
+    finally:
+        pool.close()
+        pool.join()
 
 def normalize_ksfile(ksconf, release, arch):
     '''
@@ -495,42 +570,286 @@ def get_repostrs_from_ks(ks):
 
     return kickstart_repos
 
-def _get_uncompressed_data_from_url(url, filename, proxies):
-    filename = myurlgrab(url.full, filename, proxies)
-    suffix = None
-    if filename.endswith(".gz"):
-        suffix = ".gz"
-        runner.quiet(['gunzip', "-f", filename])
-    elif filename.endswith(".bz2"):
-        suffix = ".bz2"
-        runner.quiet(['bunzip2', "-f", filename])
-    if suffix:
-        filename = filename.replace(suffix, "")
-    return filename
-
-def _get_metadata_from_repo(baseurl, proxies, cachedir, reponame, filename,
-                            sumtype=None, checksum=None):
-    url = baseurl.join(filename)
+# suffixes of the compressed metadata files, and their compress format
+_METADATA_COMPRESS_SUFFIXES = {".gz": "gz", ".bz2": "bz2",
+                               ".xz": "xz", ".zst": "zst"}
+
+class _HashingWriter(object):
+    """ Write to 'fileobj' and update 'hash_obj' on the way """
+    def __init__(self, fileobj, hash_obj):
+        self._fileobj = fileobj
+        self._hash_obj = hash_obj
+
+    def write(self, data):
+        if self._hash_obj:
+            self._hash_obj.update(data)
+        self._fileobj.write(data)
+
+def _new_metadata_hash(sumtype):
+    if sumtype == "sha":
+        sumtype = "sha1"
+    try:
+        return hashlib.new(sumtype)
+    except ValueError:
+        return None
+
+def _save_metadata_checksum(filename, sumtype, checksum):
+    """ Save the checksum of the metadata file 'filename' in a sidecar file,
+    with the size and mtime the file had, see _load_metadata_checksum()
+    """
+    stat = os.stat(filename)
+    with open(filename + ".checksum.part", "w") as fobj:
+        json.dump({"sumtype": sumtype, "checksum": checksum,
+                   "size": stat.st_size, "mtime": stat.st_mtime}, fobj)
+    os.rename(filename + ".checksum.part", filename + ".checksum")
+
+def _load_metadata_checksum(filename):
+    """ Return the (sumtype, checksum) saved for the metadata file
+    'filename', or None if there is none or the file changed since
+    """
+    try:
+        with open(filename + ".checksum") as fobj:
+            saved = json.load(fobj)
+        stat = os.stat(filename)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if saved.get("size") != stat.st_size or \
+       saved.get("mtime") != stat.st_mtime:
+        return None
+    return saved.get("sumtype"), saved.get("checksum")
+
+def _grab_metadata(job):
+    """ Fetch one metadata file in a myurlgrab_many() worker
+
+    The job is (url, filename, proxies, target, sumtype). The file is
+    written to 'filename' as it is read from the network, and a compressed
+    file is decompressed to 'target' in the same pass. The checksum of the
+    uncompressed data, of type 'sumtype', is saved next to 'target', so
+    checking the cached file later only needs a stat.
+    """
+    url, filename, proxies, target, sumtype = job
+    hash_obj = _new_metadata_hash(sumtype) if sumtype else None
+    suffix = os.path.splitext(filename)[1]
+    parts = [filename + ".part"]
+    if target != filename:
+        parts.append(target + ".part")
+
+    try:
+        fsrc = myurlopen(url, proxies)
+        try:
+            with open(parts[0], "wb") as fdl:
+                if target != filename:
+                    fout = open(parts[1], "wb")
+                    sink = open_decompressor(_HashingWriter(fout, hash_obj),
+                                        _METADATA_COMPRESS_SUFFIXES[suffix])
+                else:
+                    fout = None
+                    sink = None
+                try:
+                    while True:
+                        chunk = fsrc.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        fdl.write(chunk)
+                        if sink:
+                            sink.write(chunk)
+                        elif hash_obj:
+                            hash_obj.update(chunk)
+                    if sink:
+                        sink.close()
+                except:
+                    if sink:
+                        sink.abort()
+                    raise
+                finally:
+                    if fout:
+                        fout.close()
+        finally:
+            fsrc.close()
+
+        for part in reversed(parts):
+            os.rename(part, part[:-len(".part")])
+        if hash_obj:
+            _save_metadata_checksum(target, sumtype, hash_obj.hexdigest())
+    except (CreatorError, IOError, OSError, EOFError, zlib.error), err:
+        for part in parts:
+            if os.path.exists(part):
+                os.unlink(part)
+        return (None, "%s: %s" % (SafeURL(url), err))
+    except KeyboardInterrupt:
+        return (None, 'interrupted')
+
+    return (filename, None)
+
+def _get_cached_metadata(cachedir, reponame, filename, sumtype, checksum):
+    """ Return the (download path, uncompressed path) of a metadata file,
+    and whether the uncompressed file in cache matches the checksum
+    """
     filename_tmp = str("%s/%s/%s" % (cachedir, reponame, os.path.basename(filename)))
-    if os.path.splitext(filename_tmp)[1] in (".gz", ".bz2"):
+    if os.path.splitext(filename_tmp)[1] in _METADATA_COMPRESS_SUFFIXES:
         filename = os.path.splitext(filename_tmp)[0]
     else:
         filename = filename_tmp
     if sumtype and checksum and os.path.exists(filename):
-        try:
-            sumcmd = find_binary_path("%ssum" % sumtype)
-        except:
-            file_checksum = None
-        else:
-            file_checksum = runner.outs([sumcmd, filename]).split()[0]
+        saved = _load_metadata_checksum(filename)
+        if saved is None:
+            # cached by an older mic, hash it once and remember it
+            hash_obj = _new_metadata_hash(sumtype)
+            if hash_obj:
+                with open(filename, "rb") as fobj:
+                    for chunk in iter(lambda: fobj.read(1024 * 1024), ""):
+                        hash_obj.update(chunk)
+                _save_metadata_checksum(filename, sumtype,
+                                        hash_obj.hexdigest())
+                saved = (sumtype, hash_obj.hexdigest())
+
+        if saved == (sumtype, checksum):
+            return filename_tmp, filename, True
+
+    return filename_tmp, filename, False
+
+def _parse_repomd(repomd):
+    """ Return the revision and the {type: (href, sumtype, checksum)} of
+    the primary, patterns and comps files listed in repomd.xml
+    """
+    try:
+        root = xmlparse(repomd)
+    except SyntaxError:
+        raise CreatorError("repomd.xml syntax error.")
 
-        if file_checksum and file_checksum == checksum:
-            return filename
+    ns = root.getroot().tag
+    ns = ns[0:ns.rindex("}")+1]
 
-    return _get_uncompressed_data_from_url(url,filename_tmp,proxies)
+    revision = root.find("%srevision" % ns)
+    if revision is not None:
+        revision = revision.text
 
-def get_metadata_from_repos(repos, cachedir):
-    my_repo_metadata = []
+    files = {}
+    for item, types in (("patterns", ("patterns",)),
+                        ("comps", ("group_gz", "group")),
+                        ("primary", ("primary_db", "primary"))):
+        for elm in root.getiterator("%sdata" % ns):
+            if elm.attrib["type"] in types:
+                checksum = elm.find("%sopen-checksum" % ns)
+                files[item] = (elm.find("%slocation" % ns).attrib['href'],
+                               checksum.attrib['type'],
+                               checksum.text)
+                break
+
+    return revision, files
+
+def get_repodata_files(repomd):
+    """ Return the (type, href, sumtype, checksum) of all the files listed in
+    repomd.xml, the checksum is the one of the file as it is in the repo
+    """
+    try:
+        root = xmlparse(repomd)
+    except SyntaxError:
+        raise CreatorError("repomd.xml syntax error.")
+
+    ns = root.getroot().tag
+    ns = ns[0:ns.rindex("}")+1]
+
+    files = []
+    for elm in root.getiterator("%sdata" % ns):
+        checksum = elm.find("%schecksum" % ns)
+        sumtype = checksum.attrib['type']
+        if sumtype == "sha":
+            sumtype = "sha1"
+        files.append((elm.attrib["type"],
+                      elm.find("%slocation" % ns).attrib['href'],
+                      sumtype, checksum.text))
+
+    return files
+
+def _load_repomd_state(statefile):
+    """ Load the state of the cached repomd.xml saved by get_metadata_from_repos
+    """
+    try:
+        with open(statefile) as fobj:
+            return json.load(fobj)
+    except (IOError, ValueError):
+        return {}
+
+def _repomd_url_key(url):
+    """ Identify the repomd.xml url in the saved state, a hash of it keeps
+    the credentials in the url out of the state file """
+    return hashlib.sha256(url.full).hexdigest()
+
+def _save_repomd_state(statefile, state):
+    with open(statefile + ".part", "w") as fobj:
+        json.dump(state, fobj)
+    os.rename(statefile + ".part", statefile)
+
+def _fetch_repomd(args):
+    """ Fetch repomd.xml of a http(s) repo with a conditional GET
+
+    The ETag and Last-Modified of the cached copy are sent if the state is
+    the one of that copy. Return True if the cached copy is still current,
+    False if a new one was fetched, None if it couldn't be fetched this way,
+    then the caller falls back to urlgrabber.
+    """
+    url, filename, proxies, state = args
+    if not url.startswith("http:") and not url.startswith("https:"):
+        return None
+
+    request = urllib2.Request(str(url))
+    if url.user:
+        userpass = "%s:%s" % (url.user, url.passwd or "")
+        request.add_header("Authorization",
+                           "Basic %s" % base64.b64encode(userpass))
+    if state.get("url_sha256") == _repomd_url_key(url) and \
+       os.path.exists(filename) and \
+       state.get("sha256") == get_sha256sum(filename):
+        if state.get("etag"):
+            request.add_header("If-None-Match", state["etag"])
+        if state.get("last_modified"):
+            request.add_header("If-Modified-Since", state["last_modified"])
+
+    handlers = [urllib2.ProxyHandler(proxies or {})]
+    if hasattr(ssl, "_create_unverified_context"):
+        # like the other fetches, the certificate of the repo isn't verified
+        handlers.append(urllib2.HTTPSHandler(
+                            context=ssl._create_unverified_context()))
+    try:
+        response = urllib2.build_opener(*handlers).open(request, timeout=60)
+        data = response.read()
+    except urllib2.HTTPError, err:
+        if err.code == 304:
+            return True
+        msger.debug("conditional fetch of %s failed: %s" % (url, err))
+        return None
+    except (urllib2.URLError, IOError, ssl.SSLError), err:
+        msger.debug("conditional fetch of %s failed: %s" % (url, err))
+        return None
+
+    with open(filename + ".part", "wb") as fobj:
+        fobj.write(data)
+    os.rename(filename + ".part", filename)
+
+    # the rest of the state is still right if the content didn't change
+    if state.get("url_sha256") != _repomd_url_key(url):
+        state.clear()
+    state["url_sha256"] = _repomd_url_key(url)
+    state["etag"] = response.info().getheader("ETag")
+    state["last_modified"] = response.info().getheader("Last-Modified")
+    return False
+
+def get_metadata_from_repos(repos, cachedir, jobs = 4):
+    """ Fetch the metadata of all repos, up to 'jobs' files in parallel
+
+    repomd.xml of every repo is fetched first, then the primary, patterns,
+    comps and repomd.xml.key files all repos need. The returned list is in
+    the order of 'repos'.
+
+    The ETag, Last-Modified and revision of repomd.xml are kept next to it,
+    repomd.xml is only fetched again if it changed. The metadata of a repo
+    whose repomd.xml didn't change since its metadata were all fetched is
+    reused as it is, without checking or fetching anything else.
+    """
+    repoinfo = []
+    grabs = []
     for repo in repos:
         reponame = repo.name
         baseurl = repo.baseurl
@@ -545,71 +864,85 @@ def get_metadata_from_repos(repos, cachedir):
             proxies = {str(baseurl.split(":")[0]): str(proxy)}
 
         makedirs(os.path.join(cachedir, reponame))
+        cachemgr.touch(os.path.join(cachedir, reponame))
         url = baseurl.join("repodata/repomd.xml")
         filename = os.path.join(cachedir, reponame, 'repomd.xml')
-        repomd = myurlgrab(url.full, filename, proxies)
-        try:
-            root = xmlparse(repomd)
-        except SyntaxError:
-            raise CreatorError("repomd.xml syntax error.")
-
-        ns = root.getroot().tag
-        ns = ns[0:ns.rindex("}")+1]
+        state = _load_repomd_state(filename + ".state")
+        repoinfo.append((reponame, baseurl, proxies, url, filename, state))
 
-        filepaths = {}
-        checksums = {}
-        sumtypes = {}
-
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] == "patterns":
-                filepaths['patterns'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['patterns'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['patterns'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
-
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] in ("group_gz", "group"):
-                filepaths['comps'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['comps'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['comps'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
+    pool = multiprocessing.dummy.Pool(max(1, min(jobs, len(repoinfo))))
+    try:
+        fetched = pool.map(_fetch_repomd,
+                           [(url, filename, proxies, state) for
+                            reponame, baseurl, proxies, url, filename, state
+                            in repoinfo])
+    finally:
+        pool.close()
+        pool.join()
+
+    progress = TextProgress()
+    for (reponame, baseurl, proxies, url, filename, state), current in \
+            zip(repoinfo, fetched):
+        if current is False:
+            progress.start(filename, url)
+            progress.end()
+        elif current is None:
+            if state.get("url_sha256") != _repomd_url_key(url):
+                state.clear()
+            state.update(url_sha256 = _repomd_url_key(url), etag = None,
+                         last_modified = None)
+            grabs.append((url.full, filename, proxies))
+    myurlgrab_many(grabs, jobs, progress)
 
-        primary_type = None
-        for elm in root.getiterator("%sdata" % ns):
-            if elm.attrib["type"] in ("primary_db", "primary"):
-                primary_type = elm.attrib["type"]
-                filepaths['primary'] = elm.find("%slocation" % ns).attrib['href']
-                checksums['primary'] = elm.find("%sopen-checksum" % ns).text
-                sumtypes['primary'] = elm.find("%sopen-checksum" % ns).attrib['type']
-                break
+    my_repo_metadata = []
+    grabs = []
+    keyfiles = []
+    newindex = []
+    newstate = []
+    for reponame, baseurl, proxies, url, repomd, state in repoinfo:
+        # the parsed metadata of a repomd.xml seen before is in the index
+        indexfile = os.path.join(cachedir, reponame, 'index.sqlite')
+        repomd_sum = get_sha256sum(repomd)
+        index = RepoMetadataIndex.load(indexfile, repomd_sum)
+        if index:
+            revision, files = index.revision, index.files
+        else:
+            revision, files = _parse_repomd(repomd)
 
-        if not primary_type:
+        if "primary" not in files:
             continue
 
+        # all the metadata of this repomd.xml were fetched and checked by
+        # an earlier run, they are used as they are
+        complete = index and state.get("complete") and \
+                   state.get("sha256") == repomd_sum
+
+        filepaths = {}
         for item in ("primary", "patterns", "comps"):
-            if item not in filepaths:
+            if item not in files:
                 filepaths[item] = None
                 continue
-            if not filepaths[item]:
+            href, sumtype, checksum = files[item]
+            if complete:
+                sumtype = checksum = None
+            dlpath, filepaths[item], cached = _get_cached_metadata(cachedir,
+                                                    reponame, href,
+                                                    sumtype, checksum)
+            if complete and os.path.exists(filepaths[item]):
                 continue
-            filepaths[item] = _get_metadata_from_repo(baseurl,
-                                                      proxies,
-                                                      cachedir,
-                                                      reponame,
-                                                      filepaths[item],
-                                                      sumtypes[item],
-                                                      checksums[item])
+            if not cached:
+                complete = False
+                grabs.append((baseurl.join(href).full, dlpath, proxies,
+                              filepaths[item], sumtype))
 
         """ Get repo key """
-        try:
-            repokey = _get_metadata_from_repo(baseurl,
-                                              proxies,
-                                              cachedir,
-                                              reponame,
-                                              "repodata/repomd.xml.key")
-        except CreatorError:
-            repokey = None
-            msger.debug("\ncan't get %s/%s" % (baseurl, "repodata/repomd.xml.key"))
+        keyfile = str("%s/%s/repomd.xml.key" % (cachedir, reponame))
+        if not complete:
+            grabs.append((baseurl.join("repodata/repomd.xml.key").full,
+                          keyfile, proxies, keyfile, None))
+            keyfiles.append(keyfile)
+        elif not state.get("repokey"):
+            keyfile = None
 
         my_repo_metadata.append({"name":reponame,
                                  "baseurl":baseurl,
@@ -619,58 +952,295 @@ def get_metadata_from_repos(repos, cachedir):
                                  "proxies":proxies,
                                  "patterns":filepaths['patterns'],
                                  "comps":filepaths['comps'],
-                                 "repokey":repokey})
+                                 "repokey":keyfile,
+                                 "index":index})
+        if not index:
+            newindex.append((my_repo_metadata[-1], revision, files,
+                             indexfile, repomd_sum))
+        if not complete:
+            state.update(revision = revision, sha256 = repomd_sum)
+            newstate.append((my_repo_metadata[-1], state, repomd + ".state"))
+
+    fetched = myurlgrab_many(grabs, jobs, TextProgress(), keyfiles,
+                             grab = _grab_metadata)
+    missed = [job[1] for job, path in zip(grabs, fetched) if path is None]
+
+    for repo in my_repo_metadata:
+        if repo["repokey"] in missed:
+            repo["repokey"] = None
+
+    # index the primary files of the repos with a new repomd.xml
+    for repo, revision, files, indexfile, repomd_sum in newindex:
+        index = RepoMetadataIndex(repo["primary"])
+        index.revision = revision
+        index.files = files
+        index.save(indexfile, repomd_sum)
+        repo["index"] = index
+
+    # everything is in place, the next run can reuse it
+    for repo, state, statefile in newstate:
+        state.update(complete = True, repokey = repo["repokey"] is not None)
+        _save_repomd_state(statefile, state)
 
     return my_repo_metadata
 
+class RepoMetadataIndex(object):
+    """ Package index of the primary metadata of one repo
+
+    The primary file is parsed once, packages are kept by name with the
+    fields the helpers below look up, so each query is a dict access
+    instead of a full walk of primary.xml.
+
+    The index can be saved to a sqlite file next to the repo metadata,
+    keyed by the checksum of repomd.xml. Loading it back doesn't parse
+    anything, packages are read from the file by name when looked up.
+    """
+    # bump it when the layout of the saved index changes
+    version = "3"
+
+    def __init__(self, primary = None):
+        self.primary = primary
+        self.revision = None
+        # metadata files listed in repomd.xml, see _parse_repomd()
+        self.files = {}
+        # package name -> list of package entries
+        self.packages = {}
+        # arches in the order they appear in primary
+        self.arches = []
+        self._db = None
+
+        if not primary:
+            return
+        if primary.endswith(".xml"):
+            self._load_xml(primary)
+        elif primary.endswith(".sqlite"):
+            self._load_sqlite(primary)
+
+    @classmethod
+    def load(cls, indexfile, repomd_sum):
+        """ Return the index saved in 'indexfile' if it was built from the
+        repomd.xml with checksum 'repomd_sum', otherwise None
+        """
+        if not os.path.exists(indexfile):
+            return None
+
+        try:
+            con = sqlite.connect(indexfile)
+            meta = dict(con.execute("select key, value from meta"))
+            if meta.get("version") != cls.version or \
+               meta.get("repomd") != repomd_sum:
+                con.close()
+                return None
+
+            index = cls()
+            index.revision = meta.get("revision")
+            for row in con.execute("select type, href, sumtype, checksum "
+                                   "from files"):
+                index.files[str(row[0])] = tuple(map(str, row[1:]))
+            index.arches = [row[0] for row in con.execute(
+                                "select arch from arches order by pos")]
+        except sqlite.Error, err:
+            msger.debug("ignore broken index %s: %s" % (indexfile, err))
+            return None
+
+        index._db = con
+        return index
+
+    def save(self, indexfile, repomd_sum):
+        """ Save the index to 'indexfile' for the repomd.xml with checksum
+        'repomd_sum', the file is replaced atomically
+        """
+        tmpfile = "%s.%d" % (indexfile, os.getpid())
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+        try:
+            con = sqlite.connect(tmpfile)
+            con.executescript("""
+                create table meta (key text primary key, value text);
+                create table files (type text primary key, href text,
+                                    sumtype text, checksum text);
+                create table arches (pos integer, arch text);
+                create table packages (name text, arch text, version text,
+                                       release text, location text,
+                                       sourcerpm text, sumtype text,
+                                       checksum text, size integer,
+                                       deps text);
+                create index packages_name on packages (name);
+                """)
+            con.executemany("insert into meta values (?, ?)",
+                            [("version", self.version),
+                             ("repomd", repomd_sum),
+                             ("revision", self.revision)])
+            con.executemany("insert into files values (?, ?, ?, ?)",
+                            [(k,) + v for k, v in self.files.iteritems()])
+            con.executemany("insert into arches values (?, ?)",
+                            enumerate(self.arches))
+            for entries in self.packages.itervalues():
+                con.executemany("insert into packages values "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(e["name"], e["arch"], e["version"],
+                                  e["release"], e["location"], e["sourcerpm"],
+                                  e["sumtype"], e["checksum"], e["size"],
+                                  e["deps"])
+                                 for e in entries])
+            con.commit()
+            con.close()
+            os.rename(tmpfile, indexfile)
+        except (sqlite.Error, OSError), err:
+            msger.debug("failed to save index %s: %s" % (indexfile, err))
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    def _add(self, name, arch, version, release, location, sourcerpm,
+             sumtype, checksum, size, deps):
+        entry = {"name": name,
+                 "arch": arch,
+                 "version": version,
+                 "release": release,
+                 "location": location,
+                 "sourcerpm": sourcerpm,
+                 "sumtype": sumtype,
+                 "checksum": checksum,
+                 "size": size,
+                 # json of the epoch and the provides, requires and files
+                 # of the package, see deps_of()
+                 "deps": deps}
+        self.packages.setdefault(name, []).append(entry)
+        if self._db is None and arch not in self.arches:
+            self.arches.append(arch)
+
+    def _load_xml(self, primary):
+        try:
+            context = cElementTree.iterparse(primary, events=("start", "end"))
+            event, root = context.next()
+        except SyntaxError:
+            raise CreatorError("%s syntax error." % primary)
+
+        ns = root.tag
+        ns = ns[0:ns.rindex("}")+1]
+        for event, elm in context:
+            if event != "end" or elm.tag != "%spackage" % ns:
+                continue
+
+            version = elm.find("%sversion" % ns)
+            sourcerpm = None
+            provides = []
+            requires = []
+            files = []
+            fmt = elm.find("%sformat" % ns)
+            if fmt:
+                fns = fmt.getchildren()[0].tag
+                fns = fns[0:fns.rindex("}")+1]
+                srpm = fmt.find("%ssourcerpm" % fns)
+                if srpm is not None:
+                    sourcerpm = srpm.text
+                for deps, tag in ((provides, "provides"),
+                                  (requires, "requires")):
+                    for dep in fmt.findall("%s%s/%sentry" % (fns, tag, fns)):
+                        deps.append([dep.get(attr) for attr in
+                                     ("name", "flags", "epoch", "ver", "rel")])
+                files = [f.text for f in fmt.findall("%sfile" % ns)]
+
+            checksum = elm.find("%schecksum" % ns)
+            size = elm.find("%ssize" % ns)
+            if size is not None:
+                size = int(size.attrib['package'])
+
+            self._add(elm.find("%sname" % ns).text,
+                      elm.find("%sarch" % ns).text,
+                      version.attrib['ver'],
+                      version.attrib['rel'],
+                      elm.find("%slocation" % ns).attrib['href'],
+                      sourcerpm,
+                      checksum.attrib['type'],
+                      checksum.text,
+                      size,
+                      json.dumps([version.get("epoch"), provides, requires,
+                                  files]))
+            root.clear()
+
+    def _load_sqlite(self, primary):
+        con = sqlite.connect(primary)
+        deps = {}
+        for table in ("provides", "requires"):
+            for row in con.execute("select pkgKey, name, flags, epoch, "
+                                   "version, release from %s" % table):
+                deps.setdefault((table, row[0]), []).append(list(row[1:]))
+        for row in con.execute("select pkgKey, name from files"):
+            deps.setdefault(("files", row[0]), []).append(row[1])
+
+        for row in con.execute("select pkgKey, epoch, name, arch, version, "
+                               "release, location_href, rpm_sourcerpm, "
+                               "checksum_type, pkgId, size_package "
+                               "from packages"):
+            pkgkey, epoch = row[0:2]
+            self._add(*(row[2:] + (json.dumps([epoch] + [
+                                    deps.get((table, pkgkey), []) for table
+                                    in ("provides", "requires", "files")]),)))
+        con.close()
+
+    def get(self, name, arches = None):
+        """ Return the entries of package 'name', only the ones in
+        'arches' if it is given
+        """
+        if self._db is not None and name not in self.packages:
+            for row in self._db.execute("select name, arch, version, release, "
+                                        "location, sourcerpm, sumtype, "
+                                        "checksum, size, deps from packages "
+                                        "where name = ?", (name,)):
+                self._add(*row)
+            self.packages.setdefault(name, [])
+        entries = self.packages.get(name, [])
+        if arches is None:
+            return entries
+        return [e for e in entries if e["arch"] in arches]
+
+    @staticmethod
+    def deps_of(entry):
+        """ Return the dependencies of a package entry, in the form
+        rpmmisc.checkDependencies() takes
+        """
+        epoch, provides, requires, files = json.loads(entry["deps"] or
+                                                      '[null, [], [], []]')
+        tostr = lambda value: value if value is None else str(value)
+        todep = lambda dep: (str(dep[0]), tostr(dep[1]),
+                             tuple(map(tostr, dep[2:5])))
+        return (str(entry["name"]),
+                (tostr(epoch), str(entry["version"]), str(entry["release"])),
+                map(todep, provides), map(todep, requires), map(str, files))
+
+def _repo_index(repo):
+    if not repo.get("index"):
+        repo["index"] = RepoMetadataIndex(repo["primary"])
+    return repo["index"]
+
+def _newest_package(entries, ver = ""):
+    target = None
+    for entry in entries:
+        tmpver = "%s-%s" % (entry["version"], entry["release"])
+        if tmpver > ver:
+            ver = tmpver
+            target = entry
+    return target, ver
+
 def get_rpmver_in_repo(repometadata):
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-
-            versionlist = []
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == 'rpm':
-                    for node in elm.getchildren():
-                        if node.tag == "%sversion" % ns:
-                            versionlist.append(node.attrib['ver'])
-
-            if versionlist:
-                return reversed(
-                         sorted(
-                           versionlist,
-                           key = lambda ver: map(int, ver.split('.')))).next()
-
-        elif repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select version from packages where "
-                                   "name=\"rpm\" ORDER by version DESC"):
-                con.close()
-                return row[0]
+        versionlist = [e["version"] for e in _repo_index(repo).get('rpm')]
+        if versionlist:
+            return reversed(
+                     sorted(
+                       versionlist,
+                       key = lambda ver: map(int, ver.split('.')))).next()
 
     return None
 
 def get_arch(repometadata):
     archlist = []
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sarch" % ns).text not in ("noarch", "src"):
-                    arch = elm.find("%sarch" % ns).text
-                    if arch not in archlist:
-                        archlist.append(arch)
-        elif repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select arch from packages where arch not in (\"src\", \"noarch\")"):
-                if row[0] not in archlist:
-                    archlist.append(row[0])
-
-            con.close()
+        for arch in _repo_index(repo).arches:
+            if arch not in ("noarch", "src") and arch not in archlist:
+                archlist.append(arch)
 
     uniq_arch = []
     for i in range(len(archlist)):
@@ -695,11 +1265,14 @@ def get_arch(repometadata):
 
     return uniq_arch, archlist
 
-def get_package(pkg, repometadata, arch = None):
+def _find_package(pkg, repometadata, arch = None):
+    """ Return the (entry, repo) of the newest package 'pkg' for 'arch' in
+    the repos, (None, None) if there is none
+    """
     ver = ""
-    target_repo = None
+    target_entry = target_repo = None
     if not arch:
-        arches = []
+        arches = None
     elif arch not in rpmmisc.archPolicies:
         arches = [arch]
     else:
@@ -707,52 +1280,41 @@ def get_package(pkg, repometadata, arch = None):
         arches.append('noarch')
 
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == pkg:
-                    if elm.find("%sarch" % ns).text in arches:
-                        version = elm.find("%sversion" % ns)
-                        tmpver = "%s-%s" % (version.attrib['ver'], version.attrib['rel'])
-                        if tmpver > ver:
-                            ver = tmpver
-                            location = elm.find("%slocation" % ns)
-                            pkgpath = "%s" % location.attrib['href']
-                            target_repo = repo
-                        break
-        if repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            if arch:
-                sql = 'select version, release, location_href from packages ' \
-                      'where name = "%s" and arch IN ("%s")' % \
-                      (pkg, '","'.join(arches))
-                for row in con.execute(sql):
-                    tmpver = "%s-%s" % (row[0], row[1])
-                    if tmpver > ver:
-                        ver = tmpver
-                        pkgpath = "%s" % row[2]
-                        target_repo = repo
-                    break
-            else:
-                sql = 'select version, release, location_href from packages ' \
-                      'where name = "%s"' % pkg
-                for row in con.execute(sql):
-                    tmpver = "%s-%s" % (row[0], row[1])
-                    if tmpver > ver:
-                        ver = tmpver
-                        pkgpath = "%s" % row[2]
-                        target_repo = repo
-                    break
-            con.close()
+        entry, ver = _newest_package(_repo_index(repo).get(pkg, arches), ver)
+        if entry:
+            target_entry = entry
+            target_repo = repo
+
+    return target_entry, target_repo
+
+def check_package_deps(pkgs, repometadata, arch = None):
+    """ Check the dependencies among the packages 'pkgs' with the repo
+    metadata, the packages not found in the repos are left out. Return the
+    unresolved ones, see rpmmisc.checkDependencies().
+    """
+    packages = []
+    for pkg in pkgs:
+        entry, repo = _find_package(pkg, repometadata, arch)
+        if entry:
+            packages.append(RepoMetadataIndex.deps_of(entry))
+    return rpmmisc.checkDependencies(packages)
+
+def get_package(pkg, repometadata, arch = None):
+    target_entry, target_repo = _find_package(pkg, repometadata, arch)
     if target_repo:
+        pkgpath = target_entry["location"]
         makedirs("%s/packages/%s" % (target_repo["cachedir"], target_repo["name"]))
         url = target_repo["baseurl"].join(pkgpath)
         filename = str("%s/packages/%s/%s" % (target_repo["cachedir"], target_repo["name"], os.path.basename(pkgpath)))
-        if os.path.exists(filename):
-            ret = rpmmisc.checkRpmIntegrity('rpm', filename)
+        if os.path.exists(filename) or \
+           pkgstore.link_package(target_entry["sumtype"],
+                                 target_entry["checksum"], filename):
+            ret = check_package_integrity(filename,
+                                          target_entry["sumtype"],
+                                          target_entry["checksum"],
+                                          target_entry["size"])
             if ret == 0:
+                cachemgr.touch(filename)
                 return filename
 
             msger.warning("package %s is damaged: %s" %
@@ -760,6 +1322,19 @@ def get_package(pkg, repometadata, arch = None):
             os.unlink(filename)
 
         pkg = myurlgrab(url.full, filename, target_repo["proxies"])
+        ret = check_package_integrity(pkg,
+                                      target_entry["sumtype"],
+                                      target_entry["checksum"],
+                                      target_entry["size"])
+        if ret != 0:
+            if pkg == filename:
+                os.unlink(filename)
+            raise CreatorError("Downloaded package %s is damaged" % url)
+
+        # only a verified download goes into the shared store
+        if pkg == filename:
+            pkgstore.add_package(target_entry["sumtype"],
+                                 target_entry["checksum"], filename)
         return pkg
     else:
         return None
@@ -786,34 +1361,12 @@ def get_source_name(pkg, repometadata):
         return None
 
     for repo in repometadata:
-        if repo["primary"].endswith(".xml"):
-            root = xmlparse(repo["primary"])
-            ns = root.getroot().tag
-            ns = ns[0:ns.rindex("}")+1]
-            for elm in root.getiterator("%spackage" % ns):
-                if elm.find("%sname" % ns).text == pkg_name:
-                    if elm.find("%sarch" % ns).text != "src":
-                        version = elm.find("%sversion" % ns)
-                        tmpver = "%s-%s" % (version.attrib['ver'], version.attrib['rel'])
-                        if tmpver > ver:
-                            ver = tmpver
-                            fmt = elm.find("%sformat" % ns)
-                            if fmt:
-                                fns = fmt.getchildren()[0].tag
-                                fns = fns[0:fns.rindex("}")+1]
-                                pkgpath = fmt.find("%ssourcerpm" % fns).text
-                                target_repo = repo
-                        break
-
-        if repo["primary"].endswith(".sqlite"):
-            con = sqlite.connect(repo["primary"])
-            for row in con.execute("select version, release, rpm_sourcerpm from packages where name = \"%s\" and arch != \"src\"" % pkg_name):
-                tmpver = "%s-%s" % (row[0], row[1])
-                if tmpver > ver:
-                    pkgpath = "%s" % row[2]
-                    target_repo = repo
-                break
-            con.close()
+        entries = [e for e in _repo_index(repo).get(pkg_name)
+                     if e["arch"] != "src"]
+        entry, ver = _newest_package(entries, ver)
+        if entry and entry["sourcerpm"]:
+            pkgpath = entry["sourcerpm"]
+            target_repo = repo
     if target_repo:
         return get_src_name(pkgpath)
     else:
@@ -0,0 +1,121 @@
+#!/usr/bin/python -tt
+#
+# Copyright (c) 2014 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc., 59
+# Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+The package store is a directory shared by all the cache directories of a
+host, where the packages are kept by the checksum the repo metadata give
+them: <store>/<sumtype>/<first two digits>/<checksum>.rpm. The packages in
+the cache of a repo are hardlinks to the files in the store, so a package
+published in several repos or used by several cache directories is fetched
+and stored once.
+
+The store only saves fetching, the packages linked from it are checked
+like any other cached package; a damaged one is fetched again and replaces
+the file in the store.
+"""
+
+import os
+import errno
+import shutil
+import tempfile
+
+from mic import msger
+
+# the directory of the package store, None if it isn't used
+_package_store = None
+
+def set_package_store(path):
+    """ Set the directory of the package store, None not to use one """
+    global _package_store
+    if path:
+        path = os.path.abspath(os.path.expanduser(path))
+    _package_store = path or None
+
+def get_package_store():
+    return _package_store
+
+def _store_path(sumtype, checksum):
+    if not _package_store or not sumtype or not checksum:
+        return None
+    if sumtype == "sha":
+        sumtype = "sha1"
+    return os.path.join(_package_store, sumtype, checksum[:2],
+                        checksum + ".rpm")
+
+def _link_or_copy(src, dst):
+    """ Hardlink 'src' to 'dst' through a temporary name, the file is copied
+    if they are on different file systems. An existing 'dst' is replaced.
+    """
+    if not os.path.isdir(os.path.dirname(dst)):
+        try:
+            os.makedirs(os.path.dirname(dst))
+        except OSError, err:
+            # another mic process may create it at the same time
+            if err.errno != errno.EEXIST:
+                raise
+
+    fd, tmp = tempfile.mkstemp(prefix=".%s." % os.path.basename(dst),
+                               dir=os.path.dirname(dst))
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError, err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+    except:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+def has_package(sumtype, checksum):
+    """ Return True if the store has the package with the checksum """
+    stored = _store_path(sumtype, checksum)
+    return bool(stored) and os.path.exists(stored)
+
+def link_package(sumtype, checksum, path):
+    """ Put the package with the checksum from the store at 'path'
+
+    Return True if the store has it, False if it must be fetched.
+    """
+    stored = _store_path(sumtype, checksum)
+    if not stored or not os.path.exists(stored):
+        return False
+
+    try:
+        _link_or_copy(stored, path)
+    except (IOError, OSError), err:
+        msger.debug("can't take %s from the package store: %s" % (path, err))
+        return False
+
+    return True
+
+def add_package(sumtype, checksum, path):
+    """ Add the package at 'path', just fetched, to the store """
+    stored = _store_path(sumtype, checksum)
+    if not stored or not os.path.exists(path):
+        return
+
+    try:
+        if os.path.exists(stored) and os.path.samefile(stored, path):
+            return
+        _link_or_copy(path, stored)
+    except (IOError, OSError), err:
+        msger.warning("can't add %s to the package store: %s" % (path, err))
@@ -22,6 +22,8 @@ import urlparse
 _my_proxies = {}
 _my_noproxy = None
 _my_noproxy_list = []
+# (scheme, host) -> proxy, the results of get_proxy_for()
+_my_proxy_cache = {}
 
 def set_proxy_environ():
     global _my_noproxy, _my_proxies
@@ -168,9 +170,20 @@ def set_proxies(proxy = None, no_proxy = None):
     _set_proxies(proxy, no_proxy)
     _set_noproxy_list()
     set_proxy_environ()
+    _my_proxy_cache.clear()
 
 def get_proxy_for(url):
-    if url.startswith('file:') or _isnoproxy(url):
+    if url.startswith('file:'):
+        return None
+
+    # the proxy only depends on the scheme and the host
+    key = (url[0:url.index(":")], urlparse.urlparse(url)[1])
+    if key not in _my_proxy_cache:
+        _my_proxy_cache[key] = _get_proxy_for(url)
+    return _my_proxy_cache[key]
+
+def _get_proxy_for(url):
+    if _isnoproxy(url):
         return None
 
     type = url[0:url.index(":")]
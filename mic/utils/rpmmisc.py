@@ -375,8 +375,16 @@ def getBaseArch():
 
         return basearch
 
+# (path, size, mtime) of a package -> the result of 'rpm -K'
+_RPM_INTEGRITY_CACHE = {}
+
 def checkRpmIntegrity(bin_rpm, package):
-    return runner.quiet([bin_rpm, "-K", "--nosignature", package])
+    stat = os.stat(package)
+    key = (os.path.realpath(package), stat.st_size, stat.st_mtime)
+    if key not in _RPM_INTEGRITY_CACHE:
+        _RPM_INTEGRITY_CACHE[key] = runner.quiet([bin_rpm, "-K",
+                                                  "--nosignature", package])
+    return _RPM_INTEGRITY_CACHE[key]
 
 def checkSig(ts, package):
     """ Takes a transaction set and a package, check it's sigs,
@@ -441,3 +449,121 @@ def getSigInfo(hdr):
     infotuple = (sigtype, sigdate, sigid)
     return error, infotuple
 
+
+# the sense flags of a dependency in repo metadata
+_DEP_FLAGS = {
+               "LT": rpm.RPMSENSE_LESS,
+               "LE": rpm.RPMSENSE_LESS | rpm.RPMSENSE_EQUAL,
+               "EQ": rpm.RPMSENSE_EQUAL,
+               "GE": rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL,
+               "GT": rpm.RPMSENSE_GREATER,
+             }
+
+def _formatEVR(evr):
+    (epoch, version, release) = evr
+    string = version or ''
+    if epoch and epoch != '0':
+        string = "%s:%s" % (epoch, string)
+    if release:
+        string = "%s-%s" % (string, release)
+    return string
+
+def _epoch(epoch):
+    """ A missing epoch is epoch 0, for labelCompare() """
+    if epoch is None or str(epoch) in ("", "None"):
+        return "0"
+    return str(epoch)
+
+def _depSatisfied(provide, require):
+    """ Whether the (name, flags, (epoch, version, release)) provide meets
+    the require of the same name
+    """
+    pflags, pevr = provide[1:]
+    rflags, revr = require[1:]
+    if not rflags or not pflags or not revr[1]:
+        return True
+    if pflags != "EQ":
+        # versioned ranges are hardly ever provided, don't second-guess them
+        return True
+
+    prelease = revr[2] and pevr[2] or ''
+    result = rpm.labelCompare((_epoch(pevr[0]), pevr[1] or '', prelease),
+                              (_epoch(revr[0]), revr[1], revr[2] or ''))
+    return (result < 0 and "L" in rflags) or \
+           (result == 0 and "E" in rflags) or \
+           (result > 0 and "G" in rflags)
+
+def evrInRange(evr, dep):
+    """ Whether the (epoch, version, release) evr is in the range of the
+    (name, flags, (epoch, version, release)) dependency
+    """
+    return _depSatisfied((dep[0], "EQ", evr), dep)
+
+def checkDependencies(packages):
+    """ Check the requires of a package set against its provides, from the
+    repo metadata only, before any package is downloaded
+
+    'packages' is a list of (name, (epoch, version, release), provides,
+    requires, files), the dependencies are (name, flags, (epoch, version,
+    release)) with flags "LT", "LE", "EQ", "GE", "GT" or None. 'files' is
+    None if the files of the package aren't known, then the file requires
+    no provide meets are not checked. Return the unresolved requires like
+    TransactionSet.check() does, see warnUnresolvedDeps().
+    """
+    provided = {}
+    files = set()
+    files_known = True
+    for (name, evr, provides, requires, pkgfiles) in packages:
+        provided.setdefault(name, []).append((name, "EQ", evr))
+        for provide in provides:
+            provided.setdefault(provide[0], []).append(provide)
+        if pkgfiles is None:
+            files_known = False
+        else:
+            files.update(pkgfiles)
+
+    unresolved = []
+    for (name, evr, provides, requires, pkgfiles) in packages:
+        for require in requires:
+            rname = require[0]
+            if rname.startswith("rpmlib(") or rname.startswith("("):
+                # rpm features and rich dependencies
+                continue
+            if rname in files:
+                continue
+            if [p for p in provided.get(rname, ())
+                  if _depSatisfied(p, require)]:
+                continue
+            if rname.startswith("/") and not files_known:
+                continue
+
+            unresolved.append(((name, evr[1], evr[2]),
+                               (rname, _formatEVR(require[2])),
+                               _DEP_FLAGS.get(require[1], 0),
+                               rpm.RPMDEP_SENSE_REQUIRES,
+                               None))
+
+    return unresolved
+
+def warnUnresolvedDeps(unresolved):
+    """ Show the unresolved dependencies returned by TransactionSet.check()
+    or checkDependencies()
+    """
+    for pkg, need, needflags, sense, key in unresolved:
+        package = '-'.join(pkg)
+
+        if needflags == rpm.RPMSENSE_LESS:
+            deppkg = ' < '.join(need)
+        elif needflags == rpm.RPMSENSE_EQUAL:
+            deppkg = ' = '.join(need)
+        elif needflags == rpm.RPMSENSE_GREATER:
+            deppkg = ' > '.join(need)
+        else:
+            deppkg = '-'.join(need)
+
+        if sense == rpm.RPMDEP_SENSE_REQUIRES:
+            msger.warning("[%s] Requires [%s], which is not provided" \
+                          % (package, deppkg))
+
+        elif sense == rpm.RPMDEP_SENSE_CONFLICTS:
+            msger.warning("[%s] Conflicts with [%s]" % (package, deppkg))
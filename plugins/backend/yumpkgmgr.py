@@ -26,7 +26,7 @@ import yum
 
 from mic import msger
 from mic.kickstart import ksparser
-from mic.utils import misc, rpmmisc
+from mic.utils import misc, rpmmisc, pkgstore, cachemgr
 from mic.utils.grabber import TextProgress
 from mic.utils.proxy import get_proxy_for
 from mic.utils.errors import CreatorError
@@ -330,7 +330,8 @@ class Yum(BackendPlugin, yum.YumBase):
 
         return False
 
-    def runInstall(self, checksize = 0):
+    def __resolve(self):
+        """ Resolve the transaction, return the packages to install """
         os.environ["HOME"] = "/"
         os.environ["LD_PRELOAD"] = ""
         try:
@@ -348,6 +349,46 @@ class Yum(BackendPlugin, yum.YumBase):
                         lambda txmbr: txmbr.ts_state in ("i", "u"),
                         self.tsInfo.getMembers()))
 
+        for pkg in dlpkgs:
+            if pkg.name in self.check_pkgs:
+                self.check_pkgs.remove(pkg.name)
+
+        if self.check_pkgs:
+            raise CreatorError('Packages absent in image: %s' % ','.join(self.check_pkgs))
+
+        return dlpkgs
+
+    def planInstall(self):
+        """ Resolve the transaction without downloading or installing, and
+        return the list of the packages to install """
+        plan = []
+        for po in self.__resolve():
+            repo = self.repos.getRepo(po.repoid)
+            (sumtype, checksum) = po.returnIdSum()
+            cached = not repo.nocache and \
+                     (os.path.exists(po.localPkg()) or \
+                      pkgstore.has_package(sumtype, checksum))
+            if hasattr(po, 'installedsize'):
+                install_size = int(po.installedsize)
+            else:
+                install_size = int(po.size)
+
+            plan.append({'name': po.name,
+                         'epoch': int(po.epoch or 0),
+                         'version': po.version,
+                         'release': po.release,
+                         'arch': po.arch,
+                         'repo': po.repoid,
+                         'download_size': int(po.packagesize),
+                         'install_size': install_size,
+                         'cached': cached,
+                        })
+
+        return plan
+
+    def runInstall(self, checksize = 0):
+        dlpkgs = self.__resolve()
+
         # record all pkg and the content
         for pkg in dlpkgs:
             pkg_long_name = misc.RPM_FMT % {
@@ -363,31 +404,46 @@ class Yum(BackendPlugin, yum.YumBase):
             else:
                 self.__pkgs_license[license] = [pkg_long_name]
 
-            if pkg.name in self.check_pkgs:
-                self.check_pkgs.remove(pkg.name)
-
-        if self.check_pkgs:
-            raise CreatorError('Packages absent in image: %s' % ','.join(self.check_pkgs))
-
         total_count = len(dlpkgs)
         cached_count = 0
         download_total_size = sum(map(lambda x: int(x.packagesize), dlpkgs))
 
         msger.info("\nChecking packages cached ...")
+        cached = []
         for po in dlpkgs:
             local = po.localPkg()
-            repo = filter(lambda r: r.id == po.repoid, self.repos.listEnabled())[0]
+            repo = self.repos.getRepo(po.repoid)
             if repo.nocache and os.path.exists(local):
                 os.unlink(local)
+            (sumtype, checksum) = po.returnIdSum()
             if not os.path.exists(local):
-                continue
-            if not self.verifyPkg(local, po, False):
+                if repo.nocache or \
+                   not pkgstore.link_package(sumtype, checksum, local):
+                    continue
+            cached.append((po, (local, sumtype, checksum,
+                                int(po.packagesize))))
+
+        # the package attributes are read above, as the sqlite backed
+        # packages can't be used from other threads, and the cached files
+        # are checked in parallel
+        results = misc.check_packages_integrity([args for po, args in cached])
+        for (po, args), ret in zip(cached, results):
+            if ret != 0:
                 msger.warning("Package %s is damaged: %s" \
-                              % (os.path.basename(local), local))
+                              % (os.path.basename(args[0]), args[0]))
+                # it may be a link to the package store, don't write into it
+                os.unlink(args[0])
             else:
+                cachemgr.touch(args[0])
                 download_total_size -= int(po.packagesize)
                 cached_count += 1
 
+        for repo in self.repos.listEnabled():
+            cachemgr.touch(os.path.join(self.cachedir, repo.id))
+
+        # keep the cache in its size limit, and make room for the download
+        cachemgr.make_room(self.cachedir, download_total_size,
+                           pkgstore.get_package_store())
         cache_avail_size = misc.get_filesystem_avail(self.cachedir)
         if cache_avail_size < download_total_size:
             raise CreatorError("No enough space used for downloading.")
@@ -416,6 +472,10 @@ class Yum(BackendPlugin, yum.YumBase):
             self.downloadPkgs(dlpkgs)
             # FIXME: sigcheck?
 
+            for po in dlpkgs:
+                (sumtype, checksum) = po.returnIdSum()
+                pkgstore.add_package(sumtype, checksum, po.localPkg())
+
             self.initActionTs()
             self.populateTs(keepold=0)
 
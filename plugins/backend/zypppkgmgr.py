@@ -15,8 +15,15 @@
 # with this program; if not, write to the Free Software Foundation, Inc., 59
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+from __future__ import with_statement
 import os
+import json
+import hashlib
+import fcntl
 import shutil
+import re
+import tempfile
+import urllib
 import urlparse
 import rpm
 
@@ -27,14 +34,88 @@ if not hasattr(zypp, 'PoolQuery') or \
                       "loadSolvFile interface, please update it to enhanced "
                       "version which can be found in download.tizen.org/tools")
 
-from mic import msger
+from mic import msger, __version__ as VERSION
 from mic.kickstart import ksparser
-from mic.utils import misc, rpmmisc, runner, fs_related
-from mic.utils.grabber import myurlgrab, TextProgress
+from mic.utils import misc, rpmmisc, runner, fs_related, pkgstore, cachemgr
+from mic.utils.grabber import myurlgrab_many, myurlgrab_async, TextProgress
 from mic.utils.proxy import get_proxy_for
 from mic.utils.errors import CreatorError, RepoError, RpmError
 from mic.imager.baseimager import BaseImageCreator
 
+def _libzypp_version():
+    """ Return what tells the libzypp python-zypp uses, its version if the
+    binding exports it, the binding module file otherwise """
+    for attr in ("LIBZYPP_VERSION_STRING", "ZYPP_VERSION_STRING"):
+        if hasattr(zypp, attr):
+            return str(getattr(zypp, attr))
+
+    module = getattr(zypp, "_zypp", zypp)
+    try:
+        stat = os.stat(module.__file__)
+    except (AttributeError, OSError):
+        return None
+    return "%s:%d:%d" % (module.__file__, stat.st_size, stat.st_mtime)
+
+# the operators of a capability, and the flags of the dependency
+_CAP_OPS = {"<": "LT", "<=": "LE", "=": "EQ", "==": "EQ", ">=": "GE", ">": "GT"}
+
+def _cap_to_dep(cap):
+    """ Return the (name, flags, (epoch, version, release)) of a
+    capability, or None for the ones which aren't package dependencies
+    """
+    cap = cap.asString()
+    if cap.startswith("namespace:"):
+        return None
+
+    parts = cap.split()
+    if len(parts) == 3 and parts[1] in _CAP_OPS:
+        epoch = None
+        evr = parts[2]
+        if ':' in evr:
+            epoch, evr = evr.split(':', 1)
+        version, release = (evr.split('-', 1) + [None])[0:2]
+        return (parts[0], _CAP_OPS[parts[1]], (epoch, version, release))
+
+    return (cap, None, (None, None, None))
+
+class _PackageMatcher(object):
+    """ The package specs of a kickstart: name, name.arch, name* or *name,
+    compiled once into the sets of the exact names and names with arch, and
+    one regex of all the prefixes and suffixes
+    """
+    def __init__(self, specs, split):
+        self.names = set()
+        self.name_archs = set()
+        prefixes = []
+        suffixes = []
+        for spec in specs:
+            if spec.startswith("*") or spec.endswith("*"):
+                if spec.startswith("*"):
+                    suffixes.append(re.escape(spec[1:]))
+                if spec.endswith("*"):
+                    prefixes.append(re.escape(spec[:-1]))
+                continue
+
+            name, arch = split(spec)
+            if arch:
+                self.name_archs.add((name, arch))
+            else:
+                self.names.add(name)
+
+        regex = []
+        if prefixes:
+            regex.append("^(?:%s)" % "|".join(prefixes))
+        if suffixes:
+            regex.append("(?:%s)$" % "|".join(suffixes))
+        self.regex = None
+        if regex:
+            self.regex = re.compile("|".join(regex))
+
+    def match(self, name, arch):
+        return name in self.names or \
+               (name, arch) in self.name_archs or \
+               bool(self.regex and self.regex.search(name))
+
 class RepositoryStub:
     def __init__(self):
         self.name = None
@@ -64,10 +145,16 @@ class Zypp(BackendPlugin):
         self.__pkgs_content = {}
         self.__pkgs_vcsinfo = {}
         self.repos = []
+        self.repo_by_name = {}
         self.to_deselect = []
+        self.__deselect_matcher = None
         self.localpkgs = {}
+        self.__selections = []
+        self.__pool_index = None
+        self.__repo_revisions = {}
         self.repo_manager = None
         self.repo_manager_options = None
+        self.repos_dir = None
         self.Z = None
         self.ts = None
         self.ts_pre = None
@@ -80,6 +167,7 @@ class Zypp(BackendPlugin):
 
         self.has_prov_query = True
         self.install_debuginfo = False
+        self.download_jobs = 1
         # this can't be changed, it is used by zypp
         self.tmp_file_path = '/var/tmp'
 
@@ -100,6 +188,10 @@ class Zypp(BackendPlugin):
             self.ts_pre.closeDB()
             self.ts = None
 
+        if self.repos_dir:
+            shutil.rmtree(self.repos_dir, ignore_errors = True)
+            self.repos_dir = None
+
         self.closeRpmDB()
 
     def __del__(self):
@@ -158,8 +250,13 @@ class Zypp(BackendPlugin):
     def selectPackage(self, pkg):
         """Select a given package or package pattern, can be specified
         with name.arch or name* or *name
+
+        The selection is applied when the transaction is resolved, and
+        not at all if the resolved transaction is cached.
         """
+        self.__selections.append(("package", pkg, None))
 
+    def __select_package(self, pkg):
         if not self.Z:
             self.__initialize_zypp()
 
@@ -226,11 +323,7 @@ class Zypp(BackendPlugin):
                         cmp=lambda x,y: cmpEVR(zypp.asKindPackage(x), zypp.asKindPackage(y)),
                         reverse=True):
             item = zypp.asKindPackage(pitem)
-            if item.name() in self.excpkgs.keys() and \
-               self.excpkgs[item.name()] == item.repoInfo().name():
-                continue
-            if item.name() in self.incpkgs.keys() and \
-               self.incpkgs[item.name()] != item.repoInfo().name():
+            if self.__filtered_by_repo(item):
                 continue
 
             found = True
@@ -254,11 +347,7 @@ class Zypp(BackendPlugin):
                             cmp=lambda x,y: cmpEVR(zypp.asKindPackage(x), zypp.asKindPackage(y)),
                             reverse=True):
                 item = zypp.asKindPackage(pitem)
-                if item.name() in self.excpkgs.keys() and \
-                   self.excpkgs[item.name()] == item.repoInfo().name():
-                    continue
-                if item.name() in self.incpkgs.keys() and \
-                   self.incpkgs[item.name()] != item.repoInfo().name():
+                if self.__filtered_by_repo(item):
                     continue
 
                 found = True
@@ -271,36 +360,146 @@ class Zypp(BackendPlugin):
         else:
             raise CreatorError("Unable to find package: %s" % (pkg,))
 
-    def inDeselectPackages(self, pitem):
-        """check if specified pacakges are in the list of inDeselectPackages
+    def __index_pool(self):
+        """ Index the packages of the pool by name and by the names they
+        obsolete, for __select_packages(). A package is indexed with the
+        keys it is ranked by, in the order of cmpEVR of __select_package():
+        the rank of its arch, its repo priority and its (e, v, r).
         """
-        item = zypp.asKindPackage(pitem)
-        name = item.name()
-        for pkg in self.to_deselect:
+        packages = {}
+        obsoletes = {}
+        arches = {}
+        for pitem in self.Z.pool():
+            if not zypp.isKindPackage(pitem):
+                continue
+            item = zypp.asKindPackage(pitem)
+            edition = item.edition()
+            arch = str(item.arch())
+            arches[arch] = item.arch()
+            packages.setdefault(item.name(), []).append(
+                    (arch, int(item.repoInfo().priority()),
+                     (str(edition.epoch()), edition.version(),
+                      edition.release()),
+                     pitem, item))
+
+            for cap in item.obsoletes():
+                dep = _cap_to_dep(cap)
+                if dep:
+                    obsoletes.setdefault(dep[0], []).append((dep, pitem))
+
+        # an arch ranks above the arches compatible with it
+        rank = {}
+        for name, arch in arches.items():
+            rank[name] = len([other for other in arches.values()
+                              if str(other) != name and
+                                 other.compatible_with(arch)])
+
+        for name in packages:
+            packages[name] = [(rank[arch], -priority, evr, arch, pitem, item)
+                              for arch, priority, evr, pitem, item
+                              in packages[name]]
+
+        return packages, obsoletes
+
+    def __select_packages(self, pkgs):
+        """ Select the packages as __select_package() does, with the pool
+        indexed once for all of them. Only the packages which aren't found
+        by name are looked up by their provides with PoolQuery.
+        """
+        if not self.Z:
+            self.__initialize_zypp()
+
+        self.__pool_index = self.__index_pool()
+        packages, obsoletes = self.__pool_index
+
+        def cmpRanked(e1, e2):
+            return cmp(e1[0:2], e2[0:2]) or rpm.labelCompare(e1[2], e2[2])
+
+        def whatObsolete(name, evr):
+            for dep, pitem in obsoletes.get(name, ()):
+                if rpmmisc.evrInRange(evr, dep):
+                    return pitem
+            return None
+
+        names = packages.keys()
+        for pkg in pkgs:
             startx = pkg.startswith("*")
             endx = pkg.endswith("*")
             ispattern = startx or endx
-            pkgname, pkgarch = self._splitPkgString(pkg)
-            if not ispattern:
-                if pkgarch:
-                    if name == pkgname and str(item.arch()) == pkgarch:
-                        return True
-                else:
-                    if name == pkgname:
-                        return True
+            name, arch = self._splitPkgString(pkg)
+
+            if ispattern:
+                if startx and not endx:
+                    pattern = '%s$' % (pkg[1:])
+                if endx and not startx:
+                    pattern = '^%s' % (pkg[0:-1])
+                if endx and startx:
+                    pattern = '%s' % (pkg[1:-1])
+                regex = re.compile(pattern)
+                candidates = []
+                for pkgname in names:
+                    if regex.search(pkgname):
+                        candidates.extend(packages[pkgname])
+            elif arch:
+                candidates = packages.get(name, [])
             else:
-                if startx and name.endswith(pkg[1:]):
-                    return True
-                if endx and name.startswith(pkg[:-1]):
-                    return True
+                candidates = packages.get(pkg, [])
+
+            found = False
+            for entry in sorted(candidates, cmp=cmpRanked, reverse=True):
+                (evr, pkgarch, pitem, item) = entry[2:]
+                if self.__filtered_by_repo(item):
+                    continue
+
+                found = True
+                obspkg = whatObsolete(item.name(), evr)
+                if arch:
+                    if arch == pkgarch:
+                        pitem.status().setToBeInstalled (zypp.ResStatus.USER)
+                elif obspkg == None:
+                    pitem.status().setToBeInstalled (zypp.ResStatus.USER)
+                else:
+                    obspkg.status().setToBeInstalled (zypp.ResStatus.USER)
+                if not ispattern:
+                    break
 
+            if found:
+                continue
+            if ispattern:
+                raise CreatorError("Unable to find package: %s" % (pkg,))
+            # the name isn't in the pool, search the package provides
+            self.__select_package(pkg)
+
+    def __filtered_by_repo(self, item):
+        """ Whether the include or exclude list of a repo keeps the package
+        out of the repo it is from """
+        name = item.name()
+        if name in self.excpkgs and \
+           self.excpkgs[name] == item.repoInfo().name():
+            return True
+        if name in self.incpkgs and \
+           self.incpkgs[name] != item.repoInfo().name():
+            return True
         return False
 
+    def inDeselectPackages(self, pitem):
+        """check if specified pacakges are in the list of inDeselectPackages
+        """
+        if self.__deselect_matcher is None:
+            self.__deselect_matcher = _PackageMatcher(self.to_deselect,
+                                                      self._splitPkgString)
+        item = zypp.asKindPackage(pitem)
+        return self.__deselect_matcher.match(item.name(), str(item.arch()))
+
     def deselectPackage(self, pkg):
         """collect packages should not be installed"""
         self.to_deselect.append(pkg)
+        self.__deselect_matcher = None
 
     def selectGroup(self, grp, include = ksparser.GROUP_DEFAULT):
+        self.__selections.append(("group", grp, include))
+
+    def __select_group(self, grp, include):
         if not self.Z:
             self.__initialize_zypp()
         found = False
@@ -418,6 +617,7 @@ class Zypp(BackendPlugin):
                 baseurl.setQueryParam ("proxy", "_none_")
 
             self.repos.append(repo)
+            self.repo_by_name[repo.name] = repo
 
             repo_info.addBaseUrl(baseurl)
 
@@ -460,9 +660,121 @@ class Zypp(BackendPlugin):
     def checkPackage(self, pkg):
         self.check_pkgs.append(pkg)
 
-    def runInstall(self, checksize = 0):
+    def __transaction_key(self):
+        """ Return the key of the resolved transaction in the cache, which
+        is a hash of the metadata revisions of the repos loaded into the
+        pool, of the package selection and of the versions of libzypp and
+        mic, or None if it can't be cached """
+        if self.localpkgs:
+            return None
+
+        repos = []
+        for repo in self.repos:
+            revision = self.__repo_revisions.get(repo.name)
+            if not revision:
+                return None
+            repos.append((repo.name, revision, repo.priority))
+
+        selections = sorted(set((kind, str(name), str(include))
+                                for kind, name, include in self.__selections))
+        inputs = {'arch': self.target_arch,
+                  'repos': sorted(repos),
+                  'incpkgs': self.incpkgs,
+                  'excpkgs': self.excpkgs,
+                  'selections': selections,
+                  'deselections': sorted(set(self.to_deselect)),
+                  'debuginfo': self.install_debuginfo,
+                  'libzypp': _libzypp_version(),
+                  'mic': VERSION,
+                 }
+        return hashlib.sha256(json.dumps(inputs, sort_keys = True)).hexdigest()
+
+    def __transaction_cache(self, key):
+        return os.path.join(self.cachedir, "resolver", key + ".json")
+
+    def __load_transaction(self, key):
+        """ Return the packages of the cached transaction, None if it isn't
+        cached or its packages aren't all in the pool """
+        path = self.__transaction_cache(key)
+        try:
+            with open(path) as cached:
+                entries = json.load(cached)
+        except (IOError, ValueError):
+            return None
+
+        pool = {}
+        for pitem in self.Z.pool():
+            if not zypp.isKindPackage(pitem):
+                continue
+            item = zypp.asKindPackage(pitem)
+            pool[(item.name(), str(item.edition()), str(item.arch()),
+                  str(item.repoInfo().name()))] = item
+
+        dlpkgs = []
+        for entry in entries:
+            item = pool.get(tuple(entry))
+            if item is None:
+                msger.verbose("%s of the cached transaction isn't in the "
+                              "repos, resolving again" % entry[0])
+                return None
+            dlpkgs.append(item)
+
+        cachemgr.touch(path)
+        return dlpkgs
+
+    def __save_transaction(self, key, dlpkgs):
+        path = self.__transaction_cache(key)
+        entries = [(po.name(), str(po.edition()), str(po.arch()),
+                    str(po.repoInfo().name())) for po in dlpkgs]
+        try:
+            fs_related.makedirs(os.path.dirname(path))
+            (fd, tmp) = tempfile.mkstemp(prefix = ".%s." % key,
+                                         dir = os.path.dirname(path))
+            with os.fdopen(fd, "w") as cached:
+                json.dump(entries, cached)
+            os.rename(tmp, path)
+        except (IOError, OSError), err:
+            msger.warning("Failed to cache the resolved transaction: %s"
+                          % err)
+
+    def __resolve(self):
+        """ Resolve the transaction, return the packages to install """
         os.environ["HOME"] = "/"
         os.environ["LD_PRELOAD"] = ""
+
+        # the revisions of the key are the ones loaded into the pool
+        if not self.Z:
+            self.__initialize_zypp()
+
+        # the same selection from the same repo revisions resolves to the
+        # same transaction, the solver only runs if it isn't cached
+        key = self.__transaction_key()
+        dlpkgs = None
+        if key:
+            dlpkgs = self.__load_transaction(key)
+        if dlpkgs is not None:
+            msger.info("Using the cached transaction")
+        else:
+            dlpkgs = self.__solve()
+            if key:
+                self.__save_transaction(key, dlpkgs)
+
+        check_pkgs = set(self.check_pkgs) - set(po.name() for po in dlpkgs)
+        if check_pkgs:
+            raise CreatorError('Packages absent in image: %s' % ','.join(sorted(check_pkgs)))
+
+        return dlpkgs
+
+    def __solve(self):
+        # the packages are selected together, on one index of the pool
+        self.__select_packages([name for kind, name, include
+                                in self.__selections if kind == "package"])
+        for kind, name, include in self.__selections:
+            if kind == "group":
+                self.__select_group(name, include)
+
+        if not self.Z:
+            self.__initialize_zypp()
         self.buildTransaction()
 
         todo = zypp.GetResolvablesToInsDel(self.Z.pool())
@@ -475,22 +787,57 @@ class Zypp(BackendPlugin):
                 item = zypp.asKindPackage(pitem)
                 dlpkgs.append(item)
 
-                if item.name() in self.check_pkgs:
-                    self.check_pkgs.remove(item.name())
-
                 if not self.install_debuginfo or str(item.arch()) == "noarch":
                     continue
 
-                dipkg = self._zyppQueryPackage("%s-debuginfo" % item.name())
-                if dipkg:
-                    ditem = zypp.asKindPackage(dipkg)
-                    dlpkgs.append(ditem)
+                # the first one in the pool, as _zyppQueryPackage() finds
+                dipkgs = self.__pool_index[0].get("%s-debuginfo" % item.name())
+                if dipkgs:
+                    dlpkgs.append(dipkgs[0][5])
                 else:
                     msger.warning("No debuginfo rpm found for: %s" \
                                   % item.name())
 
-        if self.check_pkgs:
-            raise CreatorError('Packages absent in image: %s' % ','.join(self.check_pkgs))
+        # the deselected packages may break the dependencies the resolver
+        # found, check them with the metadata before downloading anything
+        unresolved = rpmmisc.checkDependencies(map(self.__deps_of, dlpkgs))
+        if unresolved:
+            rpmmisc.warnUnresolvedDeps(unresolved)
+            raise RepoError("Unresolved dependencies, transaction failed.")
+
+        return dlpkgs
+
+    def planInstall(self):
+        """ Resolve the transaction without downloading or installing, and
+        return the list of the packages to install """
+        plan = []
+        localpkgs = self.localpkgs.keys()
+        for po in self.__resolve():
+            repo = self.repo_by_name.get(str(po.repoInfo().name()))
+            if po.name() in localpkgs:
+                cached = True
+            elif repo and repo.nocache:
+                cached = False
+            else:
+                sumtype, checksum = self.__checksum_of(po)[0:2]
+                cached = os.path.exists(self.getLocalPkgPath(po)) or \
+                         pkgstore.has_package(sumtype, checksum)
+
+            plan.append({'name': po.name(),
+                         'epoch': int(po.edition().epoch()),
+                         'version': po.edition().version(),
+                         'release': po.edition().release(),
+                         'arch': str(po.arch()),
+                         'repo': str(po.repoInfo().name()),
+                         'download_size': int(po.downloadSize()),
+                         'install_size': int(po.installSize()),
+                         'cached': cached,
+                        })
+
+        return plan
+
+    def runInstall(self, checksize = 0):
+        dlpkgs = self.__resolve()
 
         # record all pkg and the content
         localpkgs = self.localpkgs.keys()
@@ -527,25 +874,42 @@ class Zypp(BackendPlugin):
         localpkgs = self.localpkgs.keys()
 
         msger.info("Checking packages cached ...")
+        cached = []
         for po in dlpkgs:
             # Check if it is cached locally
             if po.name() in localpkgs:
                 cached_count += 1
             else:
                 local = self.getLocalPkgPath(po)
-                name = str(po.repoInfo().name())
-                try:
-                    repo = filter(lambda r: r.name == name, self.repos)[0]
-                except IndexError:
-                    repo = None
+                repo = self.repo_by_name.get(str(po.repoInfo().name()))
                 nocache = repo.nocache if repo else False
 
                 if os.path.exists(local):
-                    if nocache or self.checkPkg(local) !=0:
+                    if nocache:
                         os.unlink(local)
                     else:
-                        download_total_size -= int(po.downloadSize())
-                        cached_count += 1
+                        cached.append((po, local))
+                elif not nocache:
+                    sumtype, checksum = self.__checksum_of(po)[0:2]
+                    if pkgstore.link_package(sumtype, checksum, local):
+                        cached.append((po, local))
+
+        # the cached files are checked in parallel
+        results = misc.check_packages_integrity(
+                    [(local,) + self.__checksum_of(po) for po, local in cached])
+        for (po, local), ret in zip(cached, results):
+            if ret != 0:
+                msger.warning("package %s is damaged: %s" \
+                              % (os.path.basename(local), local))
+                os.unlink(local)
+            else:
+                cachemgr.touch(local)
+                download_total_size -= int(po.downloadSize())
+                cached_count += 1
+
+        # keep the cache in its size limit, and make room for the download
+        cachemgr.make_room(self.cachedir, download_total_size,
+                           pkgstore.get_package_store())
         cache_avail_size = misc.get_filesystem_avail(self.cachedir)
         if cache_avail_size < download_total_size:
             raise CreatorError("No enough space used for downloading.")
@@ -564,15 +928,23 @@ class Zypp(BackendPlugin):
         msger.info("Packages: %d Total, %d Cached, %d Missed" \
                    % (total_count, cached_count, download_count))
 
+        # the header of every package is added to the transaction as soon
+        # as the package and the ones before it are at hand, while the
+        # others are downloaded
         try:
             if download_count > 0:
                 msger.info("Downloading packages ...")
-            self.downloadPkgs(dlpkgs, download_count)
+            self.downloadPkgs(dlpkgs, download_count, self.__add_install,
+                              self.__prepare_transaction)
+        except (RepoError, RpmError):
+            raise
         except CreatorError, e:
             raise CreatorError("Package download failed: %s" %(e,))
+        except Exception, e:
+            raise CreatorError("Package installation failed: %s" % (e,))
 
         try:
-            self.installPkgs(dlpkgs)
+            self.__run_transaction()
         except (RepoError, RpmError):
             raise
         except Exception, e:
@@ -638,10 +1010,12 @@ class Zypp(BackendPlugin):
         if self.repo_manager:
             return
 
-        # Clean up repo metadata
-        shutil.rmtree(self.cachedir + "/etc", ignore_errors = True)
-        shutil.rmtree(self.cachedir + "/solv", ignore_errors = True)
-        shutil.rmtree(self.cachedir + "/raw", ignore_errors = True)
+        # The raw metadata and solv caches are kept between builds, only the
+        # repo definitions are private to this process, as other mic
+        # processes may share the cachedir
+        fs_related.makedirs(self.cachedir + "/etc/zypp")
+        self.repos_dir = tempfile.mkdtemp(prefix = "repos.d.",
+                                          dir = self.cachedir + "/etc/zypp")
 
         zypp.KeyRing.setDefaultAccept( zypp.KeyRing.ACCEPT_UNSIGNED_FILE
                                      | zypp.KeyRing.ACCEPT_VERIFICATION_FAILED
@@ -653,7 +1027,7 @@ class Zypp(BackendPlugin):
                 zypp.RepoManagerOptions(zypp.Pathname(self.instroot))
 
         self.repo_manager_options.knownReposPath = \
-                zypp.Pathname(self.cachedir + "/etc/zypp/repos.d")
+                zypp.Pathname(self.repos_dir)
 
         self.repo_manager_options.repoCachePath = \
                 zypp.Pathname(self.cachedir)
@@ -669,13 +1043,140 @@ class Zypp(BackendPlugin):
 
         self.repo_manager = zypp.RepoManager(self.repo_manager_options)
 
+    def __is_raw_cache_current(self, name):
+        """ Check whether the raw metadata of the repo cached by zypp is the
+        repomd.xml fetched for this build """
+        repomd = os.path.join(self.cachedir, name, "repomd.xml")
+        raw_repomd = os.path.join(self.cachedir, "raw", name,
+                                  "repodata", "repomd.xml")
+        if not os.path.exists(repomd) or not os.path.exists(raw_repomd):
+            return False
+
+        return misc.get_sha256sum(repomd) == misc.get_sha256sum(raw_repomd)
+
+    def __get_repo_proxies(self, repo, url):
+        """ Return the proxies to fetch the metadata at 'url' of the repo
+        through when seeding the raw cache. zypp is given the proxy
+        credentials of the repo, see addRepository(), so they are put into
+        the proxy url to fetch the same files as zypp would """
+        proxy = None
+        if repo:
+            proxy = repo.proxy
+        if not proxy:
+            proxy = get_proxy_for(url)
+        if not proxy:
+            return None
+
+        parts = list(urlparse.urlsplit(proxy))
+        if repo and repo.proxy_username and parts[1] and '@' not in parts[1]:
+            userinfo = urllib.quote(repo.proxy_username, safe='')
+            if repo.proxy_password:
+                userinfo += ':' + urllib.quote(repo.proxy_password, safe='')
+            parts[1] = userinfo + '@' + parts[1]
+            proxy = urlparse.urlunsplit(parts)
+
+        return {str(url.split(':')[0]): str(proxy)}
+
+    def __seed_raw_cache(self, name):
+        """ Build the raw metadata cache of the repo from the repodata mic
+        fetched for this build, instead of having zypp download it again.
+
+        The repodata is put into a local mirror, only the files zypp uses
+        which mic doesn't have are downloaded, and zypp refreshes the repo
+        from that mirror, so it writes the raw cache and its cookie itself.
+        Return False if there is no repodata of mic to start from.
+        """
+        repodir = os.path.join(self.cachedir, name)
+        repomd = os.path.join(repodir, "repomd.xml")
+        stub = self.repo_by_name.get(name)
+        if not os.path.exists(repomd) or not stub:
+            return False
+
+        baseurl = stub.baseurl[0]
+        proxies = self.__get_repo_proxies(stub, baseurl.full)
+
+        mirror = tempfile.mkdtemp(prefix = ".mirror.", dir = repodir)
+        try:
+            fs_related.makedirs(os.path.join(mirror, "repodata"))
+            shutil.copy(repomd, os.path.join(mirror, "repodata"))
+            keyfile = os.path.join(repodir, "repomd.xml.key")
+            if os.path.exists(keyfile):
+                shutil.copy(keyfile, os.path.join(mirror, "repodata"))
+
+            grabs = []
+            checksums = []
+            for dtype, href, sumtype, checksum in \
+                    misc.get_repodata_files(repomd):
+                # zypp doesn't use these
+                if dtype in ("filelists", "other") or \
+                   dtype.endswith("_db") or dtype.endswith("_zck"):
+                    continue
+
+                dst = os.path.join(mirror, href)
+                fs_related.makedirs(os.path.dirname(dst))
+                cached = os.path.join(repodir, os.path.basename(href))
+                if os.path.exists(cached) and \
+                   misc.get_hashes(cached, (sumtype,))[sumtype] == checksum:
+                    try:
+                        os.link(cached, dst)
+                    except OSError:
+                        shutil.copy(cached, dst)
+                else:
+                    grabs.append((baseurl.join(href).full, dst, proxies))
+                    checksums.append((sumtype, checksum))
+
+            myurlgrab_many(grabs, self.download_jobs, TextProgress())
+            for (url, dst, proxies), (sumtype, checksum) in \
+                    zip(grabs, checksums):
+                if misc.get_hashes(dst, (sumtype,))[sumtype] != checksum:
+                    raise CreatorError("Checksum mismatch of %s" % url)
+
+            # same alias, so zypp stores it as the raw cache of the repo
+            repo_info = zypp.RepoInfo()
+            repo_info.setAlias(name)
+            repo_info.setName(name)
+            repo_info.setEnabled(True)
+            repo_info.addBaseUrl(zypp.Url("dir://" + mirror))
+            self.repo_manager.refreshMetadata(repo_info,
+                                        zypp.RepoManager.RefreshForced)
+        finally:
+            shutil.rmtree(mirror, ignore_errors = True)
+
+        return True
+
     def __build_repo_cache(self, name):
         repo = self.repo_manager.getRepositoryInfo(name)
-        if self.repo_manager.isCached(repo) or not repo.enabled():
+        if not repo.enabled():
             return
 
-        msger.info('Refreshing repository: %s ...' % name)
-        self.repo_manager.buildCache(repo, zypp.RepoManager.BuildIfNeeded)
+        # other mic processes sharing the cachedir may update the same repo
+        fs_related.makedirs(os.path.join(self.cachedir, name))
+        lockfile = open(os.path.join(self.cachedir, name, "zypp.lock"), "a")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            if self.__is_raw_cache_current(name):
+                msger.verbose('Using cached metadata of repository: %s' % name)
+            else:
+                msger.info('Refreshing repository: %s ...' % name)
+                try:
+                    seeded = self.__seed_raw_cache(name)
+                except Exception, err:
+                    msger.warning("Failed to reuse the metadata of "
+                                  "repository %s: %s" % (name, err))
+                    seeded = False
+
+                if not seeded:
+                    self.repo_manager.refreshMetadata(repo,
+                                            zypp.RepoManager.RefreshForced)
+
+            # the solv file is only rebuilt if the raw metadata changed
+            self.repo_manager.buildCache(repo, zypp.RepoManager.BuildIfNeeded)
+
+            for topdir in ("", "raw", "solv"):
+                cachemgr.touch(os.path.join(self.cachedir, topdir, name))
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
 
     def __initialize_zypp(self):
         if self.Z:
@@ -695,7 +1196,24 @@ class Zypp(BackendPlugin):
         for repo in repos:
             if not repo.enabled():
                 continue
-            self.repo_manager.loadFromCache(repo)
+
+            # the raw metadata is the one the solv file was built from as
+            # long as no other mic process updates the repo
+            name = str(repo.alias())
+            fs_related.makedirs(os.path.join(self.cachedir, name))
+            lockfile = open(os.path.join(self.cachedir, name, "zypp.lock"),
+                            "a")
+            fcntl.flock(lockfile, fcntl.LOCK_SH)
+            try:
+                self.repo_manager.loadFromCache(repo)
+                raw_repomd = os.path.join(self.cachedir, "raw", name,
+                                          "repodata", "repomd.xml")
+                if os.path.exists(raw_repomd):
+                    self.__repo_revisions[name] = \
+                            misc.get_sha256sum(raw_repomd)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+                lockfile.close()
 
         self.Z = zypp.ZYppFactory_instance().getZYpp()
         self.Z.initializeTarget(zypp.Pathname(self.instroot))
@@ -758,17 +1276,28 @@ class Zypp(BackendPlugin):
                           "Not a compatible architecture: %s" \
                           % (pkg, hdr['arch']))
 
-    def downloadPkgs(self, package_objects, count):
+    def downloadPkgs(self, package_objects, count, callback = None,
+                     prepare = None):
+        """ Download the packages which aren't cached
+
+        'callback' is called with each package once it is at hand, in the
+        order of 'package_objects' so every build adds them the same way: a
+        package downloaded ahead of its turn waits for the ones before it.
+        'prepare' is called before the first callback, once the download
+        workers are started, so they don't inherit what it opens.
+        """
         localpkgs = self.localpkgs.keys()
         progress_obj = TextProgress(count)
 
+        jobs = []
+        fetched = {}
         for po in package_objects:
             if po.name() in localpkgs:
                 continue
 
             filename = self.getLocalPkgPath(po)
             if os.path.exists(filename):
-                if self.checkPkg(filename) == 0:
+                if self.checkPkg(filename, po) == 0:
                     continue
 
             dirn = os.path.dirname(filename)
@@ -777,12 +1306,44 @@ class Zypp(BackendPlugin):
 
             url = self.get_url(po)
             proxies = self.get_proxies(po)
+            fetched[id(po)] = len(jobs)
+            jobs.append((url.full, filename, proxies, po))
 
-            try:
-                filename = myurlgrab(url.full, filename, proxies, progress_obj)
-            except CreatorError:
-                self.close()
-                raise
+        transfers = myurlgrab_async([job[0:3] for job in jobs],
+                                    self.download_jobs, progress_obj)
+        try:
+            if prepare:
+                prepare()
+
+            # the downloads go on in the workers meanwhile
+            results = iter(transfers)
+            done = set()
+            for po in package_objects:
+                index = fetched.get(id(po))
+                while index is not None and index not in done:
+                    done_index, path = results.next()
+                    url, filename, proxies, done_po = jobs[done_index]
+                    # a package of a local repo is used in place, 'path'
+                    # is the file in the repo then
+                    if self.checkPkg(path, done_po) != 0:
+                        if path == filename:
+                            os.unlink(filename)
+                        raise CreatorError("Downloaded package %s is "
+                                           "damaged" % url)
+                    # only a verified download goes into the shared store
+                    if path == filename:
+                        sumtype, checksum = \
+                                self.__checksum_of(done_po)[0:2]
+                        pkgstore.add_package(sumtype, checksum, filename)
+                    done.add(done_index)
+
+                if callback:
+                    callback(po)
+        except CreatorError:
+            self.close()
+            raise
+        finally:
+            transfers.close()
 
     def preinstallPkgs(self):
         if not self.ts_pre:
@@ -813,6 +1374,12 @@ class Zypp(BackendPlugin):
                 raise RepoError('Could not run transaction.')
 
     def installPkgs(self, package_objects):
+        self.__prepare_transaction()
+        for po in package_objects:
+            self.__add_install(po)
+        self.__run_transaction()
+
+    def __prepare_transaction(self):
         if not self.ts:
             self.__initialize_transaction()
 
@@ -826,32 +1393,32 @@ class Zypp(BackendPlugin):
         self.ts.setProbFilter(probfilter)
         self.ts_pre.setProbFilter(probfilter)
 
-        localpkgs = self.localpkgs.keys()
-
-        for po in package_objects:
-            pkgname = po.name()
-            if pkgname in localpkgs:
-                rpmpath = self.localpkgs[pkgname]
-            else:
-                rpmpath = self.getLocalPkgPath(po)
+    def __add_install(self, po):
+        """ Add the package to the transaction """
+        pkgname = po.name()
+        if pkgname in self.localpkgs:
+            rpmpath = self.localpkgs[pkgname]
+        else:
+            rpmpath = self.getLocalPkgPath(po)
 
-            if not os.path.exists(rpmpath):
-                # Maybe it is a local repo
-                rpmuri = self.get_url(po)
-                if rpmuri.startswith("file:/"):
-                    rpmpath = rpmuri[5:]
+        if not os.path.exists(rpmpath):
+            # Maybe it is a local repo
+            rpmuri = self.get_url(po)
+            if rpmuri.startswith("file:/"):
+                rpmpath = rpmuri[5:]
 
-            if not os.path.exists(rpmpath):
-                raise RpmError("Error: %s doesn't exist" % rpmpath)
+        if not os.path.exists(rpmpath):
+            raise RpmError("Error: %s doesn't exist" % rpmpath)
 
-            h = rpmmisc.readRpmHeader(self.ts, rpmpath)
+        h = rpmmisc.readRpmHeader(self.ts, rpmpath)
 
-            if pkgname in self.pre_pkgs:
-                msger.verbose("pre-install package added: %s" % pkgname)
-                self.ts_pre.addInstall(h, rpmpath, 'u')
+        if pkgname in self.pre_pkgs:
+            msger.verbose("pre-install package added: %s" % pkgname)
+            self.ts_pre.addInstall(h, rpmpath, 'u')
 
-            self.ts.addInstall(h, rpmpath, 'u')
+        self.ts.addInstall(h, rpmpath, 'u')
 
+    def __run_transaction(self):
         unresolved_dependencies = self.ts.check()
         if not unresolved_dependencies:
             if self.pre_pkgs:
@@ -882,25 +1449,7 @@ class Zypp(BackendPlugin):
                     raise RepoError('Could not run transaction.')
 
         else:
-            for pkg, need, needflags, sense, key in unresolved_dependencies:
-                package = '-'.join(pkg)
-
-                if needflags == rpm.RPMSENSE_LESS:
-                    deppkg = ' < '.join(need)
-                elif needflags == rpm.RPMSENSE_EQUAL:
-                    deppkg = ' = '.join(need)
-                elif needflags == rpm.RPMSENSE_GREATER:
-                    deppkg = ' > '.join(need)
-                else:
-                    deppkg = '-'.join(need)
-
-                if sense == rpm.RPMDEP_SENSE_REQUIRES:
-                    msger.warning("[%s] Requires [%s], which is not provided" \
-                                  % (package, deppkg))
-
-                elif sense == rpm.RPMDEP_SENSE_CONFLICTS:
-                    msger.warning("[%s] Conflicts with [%s]" % (package, deppkg))
-
+            rpmmisc.warnUnresolvedDeps(unresolved_dependencies)
             raise RepoError("Unresolved dependencies, transaction failed.")
 
     def __initialize_transaction(self):
@@ -916,11 +1465,39 @@ class Zypp(BackendPlugin):
             # Set to not verify DSA signatures.
             self.ts_pre.setVSFlags(rpm._RPMVSF_NOSIGNATURES|rpm._RPMVSF_NODIGESTS)
 
-    def checkPkg(self, pkg):
+    def __checksum_of(self, po):
+        """ Return the (checksum type, checksum, size) of the package in the
+        repo metadata, the checksum is None if the repo doesn't tell it """
+        sumtype = checksum = None
+        chksum = po.checksum()
+        if not chksum.empty():
+            sumtype = str(chksum.type())
+            checksum = str(chksum.checksum())
+        return (sumtype, checksum, int(po.downloadSize()))
+
+    def __deps_of(self, po):
+        """ Return the dependencies of the package in the repo metadata, in
+        the form rpmmisc.checkDependencies() takes
+        """
+        edition = po.edition()
+        evr = (str(edition.epoch()), edition.version(), edition.release())
+        provides = filter(None, map(_cap_to_dep, po.provides()))
+        requires = filter(None, map(_cap_to_dep, po.requires()))
+        # zypp doesn't tell the files of the package, only the file
+        # provides of the primary metadata are among the provides
+        return (po.name(), evr, provides, requires, None)
+
+    def checkPkg(self, pkg, po = None):
         ret = 1
         if not os.path.exists(pkg):
             return ret
-        ret = rpmmisc.checkRpmIntegrity('rpm', pkg)
+
+        # verify against the checksum and size in the repo metadata,
+        # 'rpm -K' is only needed when the repo doesn't tell them
+        if po is not None:
+            ret = misc.check_package_integrity(pkg, *self.__checksum_of(po))
+        else:
+            ret = misc.check_package_integrity(pkg)
         if ret != 0:
             msger.warning("package %s is damaged: %s" \
                           % (os.path.basename(pkg), pkg))
@@ -940,11 +1517,11 @@ class Zypp(BackendPlugin):
         proxies = None
         repoinfo = pobj.repoInfo()
         reponame = "%s" % repoinfo.name()
-        repos = filter(lambda r: r.name == reponame, self.repos)
+        repo = self.repo_by_name.get(reponame)
         repourl = str(repoinfo.baseUrls()[0])
 
-        if repos:
-            proxy = repos[0].proxy
+        if repo:
+            proxy = repo.proxy
         if not proxy:
             proxy = get_proxy_for(repourl)
         if proxy:
@@ -956,10 +1533,8 @@ class Zypp(BackendPlugin):
         if not pobj:
             return None
 
-        name = str(pobj.repoInfo().name())
-        try:
-            repo = filter(lambda r: r.name == name, self.repos)[0]
-        except IndexError:
+        repo = self.repo_by_name.get(str(pobj.repoInfo().name()))
+        if not repo:
             return None
 
         location = pobj.location()
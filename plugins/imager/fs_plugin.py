@@ -49,7 +49,7 @@ class FsPlugin(ImagerPlugin):
         if creatoropts['runtime'] == 'bootstrap':
             configmgr._ksconf = ksconf
             rt_util.bootstrap_mic()
-        elif not rt_util.inbootstrap():
+        elif not rt_util.inbootstrap() and not creatoropts['plan']:
             try:
                 fs_related.find_binary_path('mic-native')
             except errors.CreatorError:
@@ -98,6 +98,9 @@ class FsPlugin(ImagerPlugin):
         if len(recording_pkgs) > 0:
             creator._recording_pkgs = recording_pkgs
 
+        if self.print_plan(creator, creatoropts):
+            return 0
+
         self.check_image_exists(creator.destdir,
                                 creator.pack_to,
                                 [creator.name],
@@ -31,16 +31,20 @@ class LoopPlugin(ImagerPlugin):
 
     @classmethod
     @cmdln.option("--compress-disk-image", dest="compress_image",
-                  type='choice', choices=("gz", "bz2", "lzo"), default=None,
+                  type='choice', choices=("gz", "bz2", "lzo", "xz", "zst"), default=None,
                   help="Same with --compress-image")
                   # alias to compress-image for compatibility
     @cmdln.option("--compress-image", dest="compress_image",
-                  type='choice', choices=("gz", "bz2", "lzo"), default=None,
-                  help="Compress all loop images with 'gz' or 'bz2' or 'lzo',"
-                  "Note: if you want to use 'lzo', package 'lzop' is needed to"
-                  "be installed manually.")
+                  type='choice', choices=("gz", "bz2", "lzo", "xz", "zst"), default=None,
+                  help="Compress all loop images with 'gz', 'bz2', 'lzo', 'xz' "
+                  "or 'zst', Note: if you want to use 'lzo', 'xz' or 'zst', "
+                  "package 'lzop', 'xz' or 'zstd' is needed to be installed "
+                  "manually.")
     @cmdln.option("--shrink", action='store_true', default=False,
                   help="Whether to shrink loop images to minimal size")
+    @cmdln.option("--parallel-stage", action='store_true', default=False,
+                  help="Whether to resparse, compress and move the partition "
+                       "images in parallel")
     def do_create(self, subcmd, opts, *args):
         """${cmd_name}: create loop image
 
@@ -59,7 +63,7 @@ class LoopPlugin(ImagerPlugin):
         if creatoropts['runtime'] == "bootstrap":
             configmgr._ksconf = ksconf
             rt_util.bootstrap_mic()
-        elif not rt_util.inbootstrap():
+        elif not rt_util.inbootstrap() and not creatoropts['plan']:
             try:
                 fs_related.find_binary_path('mic-native')
             except errors.CreatorError:
@@ -105,11 +109,15 @@ class LoopPlugin(ImagerPlugin):
         creator = LoopImageCreator(creatoropts,
                                    pkgmgr,
                                    opts.compress_image,
-                                   opts.shrink)
+                                   opts.shrink,
+                                   opts.parallel_stage)
 
         if len(recording_pkgs) > 0:
             creator._recording_pkgs = recording_pkgs
 
+        if self.print_plan(creator, creatoropts):
+            return 0
+
         image_names = [creator.name + ".img"]
         image_names.extend(creator.get_image_names())
         self.check_image_exists(creator.destdir,
@@ -81,7 +81,7 @@ class QcowPlugin(ImagerPlugin):
         if creatoropts['runtime'] == "bootstrap":
             configmgr._ksconf = ksconf
             rt_util.bootstrap_mic()
-        elif not rt_util.inbootstrap():
+        elif not rt_util.inbootstrap() and not creatoropts['plan']:
             try:
                 fs_related.find_binary_path('mic-native')
             except errors.CreatorError:
@@ -130,6 +130,9 @@ class QcowPlugin(ImagerPlugin):
         if len(recording_pkgs) > 0:
             creator._recording_pkgs = recording_pkgs
 
+        if self.print_plan(creator, creatoropts):
+            return 0
+
         image_names = [creator.name + ".img"]
         image_names.extend(creator.get_image_names())
         cls.check_image_exists(creator.destdir,
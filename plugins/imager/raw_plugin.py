@@ -34,12 +34,13 @@ class RawPlugin(ImagerPlugin):
 
     @classmethod
     @cmdln.option("--compress-disk-image", dest = "compress_image", type = 'choice',
-                  choices = ("gz", "bz2", "lzo"), default = None,
+                  choices = ("gz", "bz2", "lzo", "xz", "zst"), default = None,
                   help = "Same with --compress-image")
     @cmdln.option("--compress-image", dest = "compress_image", type = 'choice',
-                  choices = ("gz", "bz2", "lzo"), default = None,
+                  choices = ("gz", "bz2", "lzo", "xz", "zst"), default = None,
                   help = "Compress all raw images before package, Note: if you want "
-                  "to use 'lzo', package 'lzop' is needed to be installed manually.")
+                  "to use 'lzo', 'xz' or 'zst', package 'lzop', 'xz' or 'zstd' "
+                  "is needed to be installed manually.")
     @cmdln.option("--generate-bmap", action = "store_true", default = None,
                   help = "also generate the block map file")
     @cmdln.option("--fstab-entry", dest = "fstab_entry", type = 'choice',
@@ -64,7 +65,7 @@ class RawPlugin(ImagerPlugin):
         if creatoropts['runtime'] == "bootstrap":
             configmgr._ksconf = ksconf
             rt_util.bootstrap_mic()
-        elif not rt_util.inbootstrap():
+        elif not rt_util.inbootstrap() and not creatoropts['plan']:
             try:
                 fs_related.find_binary_path('mic-native')
             except errors.CreatorError:
@@ -113,6 +114,9 @@ class RawPlugin(ImagerPlugin):
         if len(recording_pkgs) > 0:
             creator._recording_pkgs = recording_pkgs
 
+        if self.print_plan(creator, creatoropts):
+            return 0
+
         images = ["%s-%s.raw" % (creator.name, disk_name)
                   for disk_name in creator.get_disk_names()]
         self.check_image_exists(creator.destdir,
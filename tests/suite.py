@@ -8,6 +8,11 @@ import test_baseimager
 import test_runner
 import test_chroot
 import test_proxy
+import test_pkgstore
+import test_cachemgr
+import test_rpmmisc
+import test_misc
+import test_zypppkgmgr
 
 if os.getuid() != 0:
     raise SystemExit("Root permission is needed")
@@ -20,5 +25,10 @@ suite.addTests(test_baseimager.suite())
 suite.addTests(test_runner.suite())
 suite.addTests(test_chroot.suite())
 suite.addTests(test_proxy.suite())
+suite.addTests(test_pkgstore.suite())
+suite.addTests(test_cachemgr.suite())
+suite.addTests(test_rpmmisc.suite())
+suite.addTests(test_misc.suite())
+suite.addTests(test_zypppkgmgr.suite())
 result = unittest.TextTestRunner(verbosity=2).run(suite)
 sys.exit(not result.wasSuccessful())
@@ -57,7 +57,7 @@ class ArchiveTest(unittest.TestCase):
         """Test get compress format """
         compress_list = archive.get_compress_formats()
         compress_list.sort()
-        self.assertEqual(compress_list, ['bz2', 'gz', 'lzo'])
+        self.assertEqual(compress_list, ['bz2', 'gz', 'lzo', 'xz', 'zst'])
 
     def test_compress_negtive_file_path_is_required(self):
         """Test if the first parameter: file path is empty"""
@@ -117,6 +117,76 @@ class ArchiveTest(unittest.TestCase):
             self.assertTrue(os.path.exists(output_name))
             os.remove(output_name)
 
+    def test_open_compressor_gz(self):
+        """Test stream compressor format: gz"""
+        import gzip
+        import StringIO
+        data = 'mic' * 100000
+        fileobj = StringIO.StringIO()
+        compressor = archive.open_compressor(fileobj, 'gz')
+        compressor.write(data)
+        compressor.close()
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj).read(), data)
+
+    def test_open_compressor_gz_threads(self):
+        """Test stream compressor format: gz, in several blocks"""
+        import gzip
+        import StringIO
+        data = os.urandom(1024) * 10000
+        fileobj = StringIO.StringIO()
+        compressor = archive.open_compressor(fileobj, 'gz', threads=4)
+        compressor.write(data)
+        compressor.close()
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj).read(), data)
+
+    def test_open_compressor_bz2_empty(self):
+        """Test stream compressor format: bz2, without any data"""
+        import bz2
+        import StringIO
+        fileobj = StringIO.StringIO()
+        compressor = archive.open_compressor(fileobj, 'bz2')
+        compressor.close()
+        self.assertEqual(bz2.decompress(fileobj.getvalue()), '')
+
+    def test_open_decompressor_gz_members(self):
+        """Test stream decompressor format: gz, fed in small pieces"""
+        import StringIO
+        data = os.urandom(1024) * 10000
+        compressed = StringIO.StringIO()
+        compressor = archive.open_compressor(compressed, 'gz', threads=4)
+        compressor.write(data)
+        compressor.close()
+        fileobj = StringIO.StringIO()
+        decompressor = archive.open_decompressor(fileobj, 'gz')
+        compressed = compressed.getvalue()
+        for i in range(0, len(compressed), 1000):
+            decompressor.write(compressed[i:i + 1000])
+        decompressor.close()
+        self.assertEqual(fileobj.getvalue(), data)
+
+    def test_open_decompressor_negtive_truncated(self):
+        """Test stream decompressor with truncated data"""
+        import StringIO
+        for compress_format in ('gz', 'bz2'):
+            compressed = StringIO.StringIO()
+            compressor = archive.open_compressor(compressed, compress_format)
+            compressor.write(os.urandom(1024) * 100)
+            compressor.close()
+            compressed = compressed.getvalue()
+            for size in (0, 10, len(compressed) - 4):
+                decompressor = archive.open_decompressor(StringIO.StringIO(),
+                                                         compress_format)
+                decompressor.write(compressed[:size])
+                with self.assertRaises(IOError):
+                    decompressor.close()
+
+    def test_open_compressor_negtive_wrong_compress_format(self):
+        """Test wrong stream compress format"""
+        with self.assertRaises(ValueError):
+            archive.open_compressor(None, 'bzip2')
+
     def _test_compress_lzo(self):
         """Test compress format: lzo"""
         for file_item in self.files:
@@ -218,6 +288,33 @@ class ArchiveTest(unittest.TestCase):
             archive.decompress(output_name)
             self.assertTrue(os.path.exists(file_item))
 
+    @unittest.skipUnless(archive.which("xz"), "xz is not installed")
+    def test_decompress_xz(self):
+        """Test decompress
+            Format: xz
+            one parameters is given, only target file"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'xz')
+            self.assertEqual('%s.xz' % file_item, output_name)
+            self.assertFalse(os.path.exists(file_item))
+            archive.decompress(output_name)
+            self.assertTrue(os.path.exists(file_item))
+            self.assertFalse(os.path.exists(output_name))
+
+    @unittest.skipUnless(archive.which("zstd"), "zstd is not installed")
+    def test_decompress_zst(self):
+        """Test decompress
+            Format: zst
+            both two parameters are given, one is target file,
+            the other is corresponding compress format"""
+        for file_item in self.files:
+            output_name = archive.compress(file_item, 'zst')
+            self.assertEqual('%s.zst' % file_item, output_name)
+            self.assertFalse(os.path.exists(file_item))
+            archive.decompress(output_name, 'zst')
+            self.assertTrue(os.path.exists(file_item))
+            self.assertFalse(os.path.exists(output_name))
+
     def _test_decompress_lzo(self):
         """Test decompress
             Format: lzo
@@ -248,7 +345,8 @@ class ArchiveTest(unittest.TestCase):
         archive_formats = archive.get_archive_formats()
         archive_formats.sort()
         self.assertEqual(archive_formats,
-                        ["bztar", "gztar", "lzotar", "tar", 'zip'])
+                        ["bztar", "gztar", "lzotar", "tar", "xztar", 'zip',
+                         "zsttar"])
 
     def test_get_archive_suffixes(self):
         """Test get archive suffixes"""
@@ -257,7 +355,8 @@ class ArchiveTest(unittest.TestCase):
 
         self.assertEqual(archive_suffixes,
                          ['.tar', '.tar.bz', '.tar.bz2', '.tar.gz', '.tar.lzo',
-                         '.taz', '.tbz', '.tbz2', '.tgz', '.tzo', '.zip'])
+                         '.tar.xz', '.tar.zst', '.taz', '.tbz', '.tbz2', '.tgz',
+                         '.txz', '.tzo', '.tzst', '.zip'])
 
     def test_make_archive_negtive_archive_name_is_required(self):
         """Test if first parameter: file path is empty"""
@@ -362,6 +461,28 @@ class ArchiveTest(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(out_dir, 'dir2')))
             shutil.rmtree(out_dir)
 
+    def test_extract_archive_tar_sparse(self):
+        """ Test extract format: tar, with a sparse file"""
+        item = self.relative_file
+        with open(item, 'wb') as fobj:
+            fobj.seek(8 * 1024 * 1024)
+            fobj.write('mic')
+            fobj.truncate(16 * 1024 * 1024)
+
+        out_file = '%s.tar' % item
+        self.assertTrue(archive.make_archive(out_file, item))
+        self.assertTrue(os.path.getsize(out_file) < os.path.getsize(item))
+
+        out_dir = 'un_tar_dir'
+        archive.extract_archive(out_file, out_dir)
+        with open(os.path.join(out_dir, os.path.basename(item)), 'rb') as fobj:
+            data = fobj.read()
+        self.assertEqual(len(data), 16 * 1024 * 1024)
+        self.assertEqual(data[8 * 1024 * 1024:8 * 1024 * 1024 + 3], 'mic')
+        self.assertEqual(data.count('\0'), len(data) - 3)
+        shutil.rmtree(out_dir)
+        os.remove(out_file)
+
     def test_make_archive_zip_with_different_name(self):
         """ Test make_archive format: zip
             It packs the source with another name"""
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mic.utils import cachemgr
+
+def suite():
+    return unittest.makeSuite(CacheMgrTest)
+
+class CacheMgrTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def _make_file(self, path, size, days):
+        path = os.path.join(self.cachedir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fobj:
+            fobj.write('x' * size)
+        past = time.time() - days * 86400
+        os.utime(path, (past, past))
+        return path
+
+    def test_prune_lru(self):
+        old = self._make_file('packages/repo/old.rpm', 1000, 3)
+        new = self._make_file('packages/repo/new.rpm', 1000, 2)
+        self._make_file('repo/repomd.xml', 1000, 1)
+        repodir = os.path.join(self.cachedir, 'repo')
+        os.utime(repodir, (time.time() - 86400, time.time() - 86400))
+        entries = cachemgr.scan(self.cachedir)
+        self.assertEqual(len(entries), 3)
+
+        self.assertEqual(cachemgr.prune(entries, 2000), (1, 1000))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_prune_keep_used(self):
+        used = self._make_file('packages/repo/used.rpm', 1000, 3)
+        cachemgr.touch(used)
+        entries = cachemgr.scan(self.cachedir)
+        self.assertEqual(cachemgr.prune(entries, 0), (0, 0))
+        self.assertTrue(os.path.exists(used))
+
+    def test_scan_repo_entry(self):
+        self._make_file('repo/repomd.xml', 100, 1)
+        self._make_file('raw/repo/repodata/repomd.xml', 200, 1)
+        self._make_file('solv/repo/solv', 300, 1)
+        self._make_file('notarepo/file', 100, 1)
+        past = time.time() - 86400
+        for path in ('repo', 'raw/repo', 'solv/repo'):
+            os.utime(os.path.join(self.cachedir, path), (past, past))
+        entries = cachemgr.scan(self.cachedir)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].name, 'repo')
+        self.assertEqual(entries[0].size, 600)
+        self.assertEqual(len(entries[0].paths), 3)
+
+        self.assertEqual(cachemgr.prune(entries, 0), (1, 600))
+        for path in ('repo', 'raw/repo', 'solv/repo'):
+            self.assertFalse(os.path.exists(os.path.join(self.cachedir, path)))
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, 'notarepo')))
+
+    def test_scan_transactions(self):
+        old = self._make_file('resolver/old.json', 100, 3)
+        new = self._make_file('resolver/new.json', 100, 2)
+        self._make_file('resolver/.new.json.tmp', 100, 3)
+        entries = cachemgr.scan(self.cachedir)
+        self.assertEqual(sorted(entry.name for entry in entries),
+                         ['new.json', 'old.json'])
+
+        self.assertEqual(cachemgr.prune(entries, 100), (1, 100))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_scan_shared_store_package(self):
+        store = tempfile.mkdtemp()
+        other = tempfile.mkdtemp()
+        try:
+            mine = self._make_file('packages/repo/mine.rpm', 1000, 3)
+            os.link(mine, os.path.join(store, 'mine.rpm'))
+            shared = self._make_file('packages/repo/shared.rpm', 1000, 3)
+            os.link(shared, os.path.join(store, 'shared.rpm'))
+            os.link(shared, os.path.join(other, 'shared.rpm'))
+            entries = cachemgr.scan(self.cachedir, store)
+            self.assertEqual([entry.name for entry in entries], ['mine.rpm'])
+        finally:
+            shutil.rmtree(store)
+            shutil.rmtree(other)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+from mic.utils import misc, pkgstore
+from mic.utils.errors import CreatorError
+from mic.utils.safeurl import SafeURL
+
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    import sqlite
+
+PRIMARY = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common"
+          xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="2">
+<package type="rpm">
+  <name>foo</name>
+  <arch>i686</arch>
+  <version epoch="1" ver="1.0" rel="2"/>
+  <checksum type="sha256" pkgid="YES">abcd</checksum>
+  <size package="100" installed="200" archive="300"/>
+  <location href="i686/foo-1.0-2.i686.rpm"/>
+  <format>
+    <rpm:sourcerpm>foo-1.0-2.src.rpm</rpm:sourcerpm>
+    <rpm:provides>
+      <rpm:entry name="libfoo" flags="EQ" epoch="1" ver="1.0" rel="2"/>
+    </rpm:provides>
+    <rpm:requires>
+      <rpm:entry name="bar"/>
+    </rpm:requires>
+    <file>/usr/bin/foo</file>
+  </format>
+</package>
+<package type="rpm">
+  <name>bar</name>
+  <arch>noarch</arch>
+  <version epoch="0" ver="3" rel="1"/>
+  <checksum type="sha256" pkgid="YES">ef01</checksum>
+  <size package="10" installed="20" archive="30"/>
+  <location href="noarch/bar-3-1.noarch.rpm"/>
+  <format>
+    <rpm:sourcerpm>bar-3-1.src.rpm</rpm:sourcerpm>
+  </format>
+</package>
+</metadata>
+"""
+
+CWD = os.path.dirname(__file__) or '.'
+REPOURI = os.path.abspath(os.path.join(CWD, 'baseimgr_fixtures'))
+
+def suite():
+    return unittest.makeSuite(MiscTest)
+
+class MiscTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.primary = os.path.join(self.tmpdir, 'primary.xml')
+        with open(self.primary, 'w') as fobj:
+            fobj.write(PRIMARY)
+        self.indexfile = os.path.join(self.tmpdir, 'index.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index_save_load(self):
+        index = misc.RepoMetadataIndex(self.primary)
+        index.revision = '42'
+        index.files['primary'] = ('repodata/primary.xml', 'sha256', 'cdef')
+        index.save(self.indexfile, 'repomd1')
+
+        loaded = misc.RepoMetadataIndex.load(self.indexfile, 'repomd1')
+        self.assertTrue(loaded is not None)
+        self.assertEqual(loaded.revision, '42')
+        self.assertEqual(loaded.files, index.files)
+        self.assertEqual(loaded.arches, ['i686', 'noarch'])
+        for name in ('foo', 'bar'):
+            self.assertEqual(loaded.get(name), index.get(name))
+        self.assertEqual(loaded.get('foo', ['noarch']), [])
+        self.assertEqual(loaded.get('baz'), [])
+
+        deps = misc.RepoMetadataIndex.deps_of(loaded.get('foo')[0])
+        self.assertEqual(deps[0:2], ('foo', ('1', '1.0', '2')))
+        self.assertEqual(deps[2], [('libfoo', 'EQ', ('1', '1.0', '2'))])
+        self.assertEqual(deps[3], [('bar', None, (None, None, None))])
+        self.assertEqual(deps[4], ['/usr/bin/foo'])
+
+    def test_index_load_other_repomd(self):
+        misc.RepoMetadataIndex(self.primary).save(self.indexfile, 'repomd1')
+        self.assertEqual(misc.RepoMetadataIndex.load(self.indexfile,
+                                                     'repomd2'), None)
+        self.assertEqual(misc.RepoMetadataIndex.load(
+                            os.path.join(self.tmpdir, 'none.sqlite'),
+                            'repomd1'), None)
+
+    def test_index_load_other_version(self):
+        misc.RepoMetadataIndex(self.primary).save(self.indexfile, 'repomd1')
+        con = sqlite.connect(self.indexfile)
+        con.execute("update meta set value = '0' where key = 'version'")
+        con.commit()
+        con.close()
+        self.assertEqual(misc.RepoMetadataIndex.load(self.indexfile,
+                                                     'repomd1'), None)
+
+    def test_index_load_broken(self):
+        with open(self.indexfile, 'w') as fobj:
+            fobj.write('not a database')
+        self.assertEqual(misc.RepoMetadataIndex.load(self.indexfile,
+                                                     'repomd1'), None)
+
+    def test_get_hashes_cached(self):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'w') as fobj:
+            fobj.write('mic')
+        hashes = misc.get_hashes(path, ('md5', 'sha256'))
+        self.assertEqual(hashes['sha256'], hashlib.sha256('mic').hexdigest())
+        self.assertEqual(hashes['md5'], hashlib.md5('mic').hexdigest())
+
+        calc_hashes = misc.calc_hashes
+        misc.calc_hashes = None
+        try:
+            # known digests don't read the file again
+            self.assertEqual(misc.get_hashes(path, ('sha256', )),
+                             {'sha256': hashes['sha256']})
+        finally:
+            misc.calc_hashes = calc_hashes
+
+    def test_get_hashes_changed(self):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'w') as fobj:
+            fobj.write('mic')
+        os.utime(path, (1000, 1000))
+        misc.get_hashes(path, ('sha256', ))
+
+        # the size changes
+        with open(path, 'w') as fobj:
+            fobj.write('mic2')
+        os.utime(path, (1000, 1000))
+        self.assertEqual(misc.get_hashes(path, ('sha256', ))['sha256'],
+                         hashlib.sha256('mic2').hexdigest())
+
+        # the same size, the mtime changes
+        with open(path, 'w') as fobj:
+            fobj.write('mic3')
+        os.utime(path, (2000, 2000))
+        self.assertEqual(misc.get_hashes(path, ('sha256', ))['sha256'],
+                         hashlib.sha256('mic3').hexdigest())
+
+    def _local_repo(self):
+        primary = os.path.join(self.tmpdir, 'fixture-primary.xml')
+        fsrc = gzip.open(os.path.join(REPOURI, 'repodata', 'primary.xml.gz'))
+        try:
+            with open(primary, 'w') as fdst:
+                fdst.write(fsrc.read())
+        finally:
+            fsrc.close()
+        return {'name': 'test',
+                'cachedir': self.tmpdir,
+                'baseurl': SafeURL('file://' + REPOURI),
+                'proxies': None,
+                'primary': primary}
+
+    def test_get_package_verified(self):
+        repo = self._local_repo()
+        pkgstore.set_package_store(os.path.join(self.tmpdir, 'store'))
+        try:
+            self.assertEqual(misc.get_package('G', [repo], 'i586'),
+                             os.path.join(REPOURI, 'i586',
+                                          'G-0.1-1.i586.rpm'))
+
+            entry = misc._repo_index(repo).get('G')[0]
+            entry['checksum'] = '0' * 64
+            self.assertRaises(CreatorError, misc.get_package, 'G', [repo],
+                              'i586')
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                         'store')))
+        finally:
+            pkgstore.set_package_store(None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+from mic.utils import pkgstore
+
+def suite():
+    return unittest.makeSuite(PkgStoreTest)
+
+class PkgStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        pkgstore.set_package_store(os.path.join(self.tmpdir, 'store'))
+
+    def tearDown(self):
+        pkgstore.set_package_store(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_and_link(self):
+        fetched = os.path.join(self.tmpdir, 'repo1', 'a.rpm')
+        os.makedirs(os.path.dirname(fetched))
+        with open(fetched, 'w') as fobj:
+            fobj.write('rpm')
+
+        linked = os.path.join(self.tmpdir, 'repo2', 'a.rpm')
+        self.assertFalse(pkgstore.link_package('sha256', 'abcd', linked))
+        pkgstore.add_package('sha256', 'abcd', fetched)
+        self.assertTrue(pkgstore.link_package('sha256', 'abcd', linked))
+        self.assertTrue(os.path.samefile(fetched, linked))
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'store',
+                                                    'sha256', 'ab',
+                                                    'abcd.rpm')))
+
+    def test_disabled(self):
+        pkgstore.set_package_store(None)
+        linked = os.path.join(self.tmpdir, 'a.rpm')
+        self.assertFalse(pkgstore.link_package('sha256', 'abcd', linked))
+        self.assertFalse(pkgstore.link_package(None, None, linked))
+
+if __name__ == "__main__":
+    unittest.main()
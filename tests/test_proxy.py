@@ -28,6 +28,14 @@ class ProxyTest(unittest.TestCase):
         self.assertEqual(proxy.get_proxy_for('http://linux.hello.com'), None)
         self.assertEqual(proxy.get_proxy_for('http://linux.hello.com.org'), 'http://proxy.some.com:11')
 
+    def test_proxy_changed(self):
+        proxy.set_proxies('http://proxy.some.com:11', 'download.am.org')
+        self.assertEqual(proxy.get_proxy_for('http://download.am.org/a'), None)
+        self.assertEqual(proxy.get_proxy_for('http://download.am.org/b'), None)
+
+        proxy.set_proxies('http://proxy.some.com:11', 'download.tizen.org')
+        self.assertEqual(proxy.get_proxy_for('http://download.am.org/a'), 'http://proxy.some.com:11')
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+import unittest
+from mic.utils import rpmmisc
+
+def suite():
+    return unittest.makeSuite(RpmMiscTest)
+
+def _pkg(name, evr, provides=(), requires=(), files=()):
+    return (name, evr, list(provides), list(requires), files)
+
+class RpmMiscTest(unittest.TestCase):
+
+    def test_dep_satisfied(self):
+        provide = ('foo', 'EQ', ('0', '1.2', '3'))
+        self.assertTrue(rpmmisc._depSatisfied(provide,
+                                    ('foo', 'GE', ('0', '1.2', None))))
+        self.assertTrue(rpmmisc._depSatisfied(provide,
+                                    ('foo', 'LT', ('0', '1.3', None))))
+        self.assertFalse(rpmmisc._depSatisfied(provide,
+                                    ('foo', 'GT', ('0', '1.2', '3'))))
+        self.assertTrue(rpmmisc._depSatisfied(provide, ('foo', None,
+                                                        (None, None, None))))
+
+    def test_dep_satisfied_missing_epoch(self):
+        for epoch in (None, '', 'None'):
+            provide = ('foo', 'EQ', (epoch, '1.2', '3'))
+            self.assertTrue(rpmmisc._depSatisfied(provide,
+                                        ('foo', 'EQ', ('0', '1.2', '3'))))
+            self.assertFalse(rpmmisc._depSatisfied(provide,
+                                        ('foo', 'GE', ('1', '1.0', None))))
+            self.assertTrue(rpmmisc._depSatisfied(
+                                        ('foo', 'EQ', ('0', '1.2', '3')),
+                                        ('foo', 'EQ', (epoch, '1.2', '3'))))
+
+    def test_evr_in_range(self):
+        dep = ('foo', 'LT', (None, '2.0', None))
+        self.assertTrue(rpmmisc.evrInRange(('0', '1.0', '1'), dep))
+        self.assertFalse(rpmmisc.evrInRange(('0', '2.0', '1'), dep))
+        self.assertFalse(rpmmisc.evrInRange(('1', '1.0', '1'), dep))
+
+    def test_check_dependencies(self):
+        packages = [
+            _pkg('foo', ('0', '1.0', '1'),
+                 provides=[('libfoo', 'EQ', ('0', '1.0', '1'))],
+                 requires=[('bar', 'GE', (None, '2.0', None)),
+                           ('libbaz', None, (None, None, None)),
+                           ('rpmlib(PayloadIsXz)', 'LE', ('0', '5.2', '1'))]),
+            _pkg('bar', (None, '2.1', '1'),
+                 requires=[('libfoo', 'EQ', ('0', '1.0', '1'))]),
+        ]
+        unresolved = rpmmisc.checkDependencies(packages)
+        self.assertEqual(len(unresolved), 1)
+        self.assertEqual(unresolved[0][0], ('foo', '1.0', '1'))
+        self.assertEqual(unresolved[0][1], ('libbaz', ''))
+
+    def test_check_file_dependencies(self):
+        requires = [('/bin/sh', None, (None, None, None))]
+        packages = [_pkg('foo', ('0', '1.0', '1'), requires=requires),
+                    _pkg('bash', ('0', '5.0', '1'), files=['/bin/bash'])]
+        self.assertEqual(len(rpmmisc.checkDependencies(packages)), 1)
+
+        packages[1] = _pkg('bash', ('0', '5.0', '1'), files=['/bin/sh'])
+        self.assertEqual(rpmmisc.checkDependencies(packages), [])
+
+        # the files aren't known, the file requires aren't checked
+        packages[1] = _pkg('bash', ('0', '5.0', '1'), files=None)
+        self.assertEqual(rpmmisc.checkDependencies(packages), [])
+
+if __name__ == "__main__":
+    unittest.main()
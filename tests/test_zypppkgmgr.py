@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from mic import plugin as pluginmgr
+from mic.utils import pkgstore
+from mic.utils.errors import CreatorError
+from mic.utils.safeurl import SafeURL
+
+CWD = os.path.dirname(__file__) or '.'
+REPOURI = os.path.abspath(os.path.join(CWD, 'baseimgr_fixtures'))
+
+def suite():
+    return unittest.makeSuite(ZyppDownloadTest)
+
+class _Checksum(object):
+    def __init__(self, checksum):
+        self._checksum = checksum
+
+    def empty(self):
+        return False
+
+    def type(self):
+        return 'sha256'
+
+    def checksum(self):
+        return self._checksum
+
+class _Package(object):
+    """ The part of a zypp package downloadPkgs() looks at """
+    def __init__(self, location, checksum = None):
+        self.location = location
+        path = os.path.join(REPOURI, location)
+        self.size = os.path.getsize(path)
+        if checksum is None:
+            with open(path, 'rb') as fobj:
+                checksum = hashlib.sha256(fobj.read()).hexdigest()
+        self._checksum = checksum
+
+    def name(self):
+        return os.path.basename(self.location).split('-')[0]
+
+    def checksum(self):
+        return _Checksum(self._checksum)
+
+    def downloadSize(self):
+        return self.size
+
+class ZyppDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        pkgstore.set_package_store(os.path.join(self.tmpdir, 'store'))
+
+        zypp = pluginmgr.PluginMgr().get_plugins('backend')['zypp']
+        tmpdir = self.tmpdir
+
+        class LocalRepoZypp(zypp):
+            """ Zypp with its packages in a file:// repo """
+            def getLocalPkgPath(self, po):
+                return os.path.join(tmpdir, 'packages',
+                                    os.path.basename(po.location))
+
+            def get_url(self, po):
+                return SafeURL('file://' + REPOURI).join(po.location)
+
+            def get_proxies(self, po):
+                return None
+
+        self.pkgmgr = LocalRepoZypp('i686', tmpdir, tmpdir)
+
+    def tearDown(self):
+        pkgstore.set_package_store(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_download_file_repo(self):
+        packages = [_Package('i586/A-0.1-1.i586.rpm'),
+                    _Package('noarch/F-0.1-1.noarch.rpm')]
+        added = []
+        self.pkgmgr.downloadPkgs(packages, len(packages), added.append)
+        self.assertEqual(added, packages)
+        # the packages of a local repo are used in place, not stored
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'store')))
+        for po in packages:
+            self.assertTrue(os.path.exists(os.path.join(REPOURI,
+                                                        po.location)))
+
+    def test_download_file_repo_damaged(self):
+        packages = [_Package('i586/A-0.1-1.i586.rpm', '0' * 64)]
+        self.assertRaises(CreatorError, self.pkgmgr.downloadPkgs,
+                          packages, len(packages))
+        self.assertTrue(os.path.exists(os.path.join(REPOURI,
+                                                    packages[0].location)))
+
+if __name__ == "__main__":
+    unittest.main()